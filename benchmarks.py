@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+from array import array
+
+from licht import colors
+from licht.base import LightColor, LightPower, LightWhite
+from licht.lifx import (
+    HSBK, AckMode, Frame, FrameAddress, Header, LifxBackend, LightSetColor, LightState,
+    MessageType, ProtocolHeader,
+)
+from licht.simulator import LifxSimulator
+from licht.utils import _BITS, _NESTED, RESERVED, Bitfield, FieldType
+
+
+TARGET = b'\xd0\x73\xd5\x00\x00\x01\x00\x00'
+
+
+def sample_value(field, bitfield):
+    # a valid value for every field type, length fields get the count of their array
+    for other in bitfield.fields:
+        if other.length == field.name:
+            return other.count
+    if field.count is not None:
+        element_bits = field.bits // field.count
+        if isinstance(field.type, type) and issubclass(field.type, Bitfield):
+            elements = [sample(field.type) for _ in range(field.count)]
+            # arrays of Bitfields that only hold integers are flat arrays of all values
+            empty = bitfield.from_bytes(bytes(bitfield.total_bytes))
+            if isinstance(empty[field.name], array):
+                return [value for element in elements for value in element._values]
+            return elements
+        element = field._replace(bits=element_bits, count=None)
+        return [sample_value(element, bitfield) for _ in range(field.count)]
+    if isinstance(field.type, type) and issubclass(field.type, Bitfield):
+        return sample(field.type)
+    elif field.type is FieldType.bytes:
+        return b'x' * (field.bits // 8)
+    elif field.type is FieldType.bool:
+        return True
+    elif field.type is FieldType.float:
+        return 0.5
+    elif field.type is FieldType.int:
+        return -1
+    else:
+        return 1
+
+
+def sample(bitfield):
+    return bitfield(*(
+        sample_value(field, bitfield) for field in bitfield.fields if field.name is not RESERVED
+    ))
+
+
+def bit_packed(bitfield):
+    return any(
+        step[0] == _BITS or step[0] == _NESTED and bit_packed(step[2]) for step in bitfield._steps
+    )
+
+
+def codec_path(bitfield):
+    if bitfield._direct:
+        return 'direct'
+    elif bit_packed(bitfield):
+        return 'bit-packed'
+    return 'converted'
+
+
+def measure(func, repeat, min_time=0.05):
+    # the best time of repeat runs of at least min_time seconds in nanoseconds per call
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    best = min(timer.repeat(repeat, number)) / number
+    return {'ns_per_op': round(best * 1e9, 1), 'ops_per_sec': round(1 / best)}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency_result(latencies, total, errors):
+    return {
+        'ops_per_sec': round(len(latencies) / total),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'errors': errors,
+    }
+
+
+def bench_codec(repeat):
+    results = {}
+    bitfields = [Header, Frame, FrameAddress, ProtocolHeader]
+    bitfields.extend(
+        msg_type.get_bitfield() for msg_type in MessageType if msg_type.get_bitfield() is not None
+    )
+    for bitfield in bitfields:
+        value = sample(bitfield)
+        data = value.to_bytes()
+        path = codec_path(bitfield)
+        for op, func in (
+            ('encode', value.to_bytes), ('decode', lambda: bitfield.from_bytes(data)),
+            ('view', lambda: bitfield.view(data)),
+        ):
+            result = measure(func, repeat)
+            result['path'] = path
+            results['codec.{}.{}'.format(op, bitfield.__name__)] = result
+    return results
+
+
+def bench_packets(repeat):
+    backend = LifxBackend(b'lcht')
+    payload = LightSetColor(HSBK(1, 2, 3, 4), 500)
+    state = backend._make_packet(TARGET, 1, sample(LightState))
+    return {
+        'packet.make.LightSetColor': measure(
+            lambda: backend._make_packet(TARGET, 1, payload, True, True), repeat
+        ),
+        'packet.make.LightGet': measure(
+            lambda: backend._make_packet(TARGET, 1, MessageType.LightGet), repeat
+        ),
+        'packet.make_many.LightSetColor': measure(
+            lambda: backend._make_packets([(TARGET, 1, payload)] * 100, True, True), repeat
+        ),
+        'packet.parse.LightState': measure(
+            lambda: LifxBackend._parse_response(state, MessageType.LightState), repeat
+        ),
+    }
+
+
+def bench_colors(repeat):
+    color = LightColor(120, 0.5, 0.75)
+    white = LightWhite(0.5, 2700)
+    hsbk = HSBK(*LifxBackend._color_to_hsbk(color))
+    rgb = [(i % 256, (i * 7) % 256, (i * 13) % 256) for i in range(1000)]
+    packed = colors.rgb_to_hsbk(rgb)
+    return {
+        'color.to_hsbk.LightColor': measure(lambda: LifxBackend._color_to_hsbk(color), repeat),
+        'color.to_hsbk.LightWhite': measure(lambda: LifxBackend._color_to_hsbk(white), repeat),
+        'color.from_hsbk': measure(lambda: LifxBackend._to_color(hsbk), repeat),
+        'color.batch.rgb_to_hsbk_1000': measure(lambda: colors.rgb_to_hsbk(rgb), repeat),
+        'color.batch.hsbk_to_colors_1000': measure(lambda: colors.hsbk_to_colors(packed), repeat),
+    }
+
+
+def timed_calls(lights, count, call):
+    # calls call(light) count times round robin over the lights
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(count):
+        before = time.perf_counter()
+        try:
+            call(lights[i % len(lights)])
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - before)
+    return latency_result(latencies, time.perf_counter() - start, errors)
+
+
+def timed_many(lights, rounds, call):
+    # latency of every light from the start of its batch
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        before = time.perf_counter()
+        for result in call(lights):
+            latencies.append(time.perf_counter() - before)
+            errors += result.error is not None
+    return latency_result(latencies, time.perf_counter() - start, errors)
+
+
+def bench_network(args):
+    results = {}
+    simulator = LifxSimulator(
+        args.devices, latency=args.latency, jitter=args.jitter, loss=args.loss, seed=0
+    )
+    simulator.broadcast_spread = args.broadcast_spread
+    with simulator, LifxBackend(b'lcht', timeout=args.timeout) as backend:
+        # the benchmark measures licht, not the rate limit for real bulbs
+        backend.send_rate = args.send_rate
+        lights = simulator.get_lights(backend)
+        color = LightColor(120, 1, 1)
+
+        results['e2e.get_power'] = timed_calls(lights, args.count, lambda light: light.get_power())
+        results['e2e.get_state'] = timed_calls(lights, args.count, lambda light: light.get_state())
+        results['e2e.set_color'] = timed_calls(
+            lights, args.count, lambda light: light.set_color(color)
+        )
+        results['e2e.set_color_ack'] = timed_calls(
+            lights, args.count, lambda light: light.set_color(color, AckMode.ACK)
+        )
+        rounds = max(1, args.count // len(lights))
+        results['e2e.get_power_many'] = timed_many(
+            lights, rounds, lambda lights: backend.get_power_many(lights, as_completed=True)
+        )
+        results['e2e.set_power_many'] = timed_many(
+            lights, rounds,
+            lambda lights: backend.set_power_many(lights, LightPower.ON, as_completed=True),
+        )
+
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        backend.broadcast_addr = simulator.addr
+        for _ in range(args.discover_runs):
+            before = time.perf_counter()
+            found = sum(1 for _ in backend.discover_lights(timeout=5, count=args.devices))
+            latencies.append(time.perf_counter() - before)
+            errors += found != args.devices
+        results['e2e.discover'] = latency_result(latencies, time.perf_counter() - start, errors)
+        results['e2e.discover']['devices'] = args.devices
+    return results
+
+
+def compare(results, baseline, threshold):
+    # prints the change of every benchmark against the baseline and returns the names of the
+    # ones that got slower by more than threshold
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None or not old.get('ops_per_sec'):
+            continue
+        change = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        print('{:<50} {:>+8.1%}'.format(name, change), file=sys.stderr)
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+GROUPS = {
+    'codec': lambda args: bench_codec(args.repeat),
+    'packet': lambda args: bench_packets(args.repeat),
+    'color': lambda args: bench_colors(args.repeat),
+    'e2e': bench_network,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks licht and prints JSON results.')
+    parser.add_argument(
+        'groups', nargs='*', metavar='group',
+        help='run only these groups of benchmarks: {}'.format(', '.join(sorted(GROUPS))),
+    )
+    parser.add_argument('-o', '--output', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with the results in this file')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='fail if a benchmark got slower than the compared one by this fraction',
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--discover-runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--loss', type=float, default=0)
+    parser.add_argument('--timeout', type=float, default=3)
+    parser.add_argument('--send-rate', type=float, default=1000)
+    parser.add_argument('--broadcast-spread', type=float, default=0.01)
+    args = parser.parse_args()
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error('unknown group {}'.format(group))
+
+    results = {}
+    for group in args.groups or sorted(GROUPS):
+        results.update(GROUPS[group](args))
+
+    output = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'numpy': colors.numpy is not None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {
+            name: value for name, value in sorted(vars(args).items())
+            if name not in ('groups', 'output', 'compare')
+        },
+        'results': results,
+    }
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('slower: {}'.format(', '.join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -39,8 +39,11 @@ def run_test(name, print_success=True):
 
 
 def run_demo():
-    b = LifxBackend()
+    with LifxBackend() as b:
+        run_demo_with_backend(b)
 
+
+def run_demo_with_backend(b):
     print(bold('Discovering lights:'))
 
     ls = []
@@ -2,7 +2,8 @@ import colorsys
 from collections import namedtuple
 from enum import Enum
 
-from .utils import cache_method
+from .exceptions import LichtError
+from .utils import cache_method, invalidate_cached_methods
 
 
 class LightPower(Enum):
@@ -27,6 +28,12 @@ class LightColor(namedtuple('LightColorBase', ['hue', 'saturation', 'brightness'
 
 LightWhite = namedtuple('LightWhite', ['brightness', 'kelvin'])
 
+LightResult = namedtuple('LightResult', ['light', 'value', 'error'])
+
+LightStatus = namedtuple('LightStatus', ['power', 'color', 'label'])
+
+LightChange = namedtuple('LightChange', ['light', 'name', 'old', 'new'])
+
 
 class Backend(object):
     def get_light(self, *args, **kwargs):
@@ -53,8 +60,57 @@ class Backend(object):
     def fade_color(self, light, color, ms):
         pass
 
+    def get_state(self, light):
+        return LightStatus(self.get_power(light), self.get_color(light), self.get_label(light))
+
+    @staticmethod
+    def _collect_results(results, count, as_completed):
+        # results yields (index, LightResult) tuples in the order the lights finish, the
+        # requests must already be on their way because the caller might never iterate over
+        # the generator that is returned if as_completed is set
+        if as_completed:
+            return (result for index, result in results)
+        ordered = [None] * count
+        for index, result in results:
+            ordered[index] = result
+        return ordered
+
+    def _iter_many(self, lights, method, *args):
+        # calls method for one light after the other, backends that can talk to many
+        # lights at once override the *_many methods
+        for index, light in enumerate(lights):
+            try:
+                value = method(light, *args)
+            except LichtError as e:
+                yield index, LightResult(light, None, e)
+            else:
+                yield index, LightResult(light, value, None)
+
+    def _run_many(self, lights, as_completed, method, *args):
+        # all calls are made before this returns, even if the results are never used
+        lights = list(lights)
+        results = list(self._iter_many(lights, method, *args))
+        return self._collect_results(results, len(lights), as_completed)
+
+    def get_power_many(self, lights, as_completed=False):
+        return self._run_many(lights, as_completed, self.get_power)
+
+    def set_power_many(self, lights, power, as_completed=False):
+        return self._run_many(lights, as_completed, self.set_power, power)
+
+    def get_color_many(self, lights, as_completed=False):
+        return self._run_many(lights, as_completed, self.get_color)
+
+    def set_color_many(self, lights, color, as_completed=False):
+        return self.fade_color_many(lights, color, 0, as_completed)
+
+    def fade_color_many(self, lights, color, ms, as_completed=False):
+        return self._run_many(lights, as_completed, self.fade_color, color, ms)
+
 
 class Light(object):
+    __slots__ = ('backend', 'addr', '__weakref__')
+
     def __init__(self, backend, addr):
         self.backend = backend
         self.addr = addr
@@ -62,7 +118,10 @@ class Light(object):
     def __str__(self):
         return self.get_label()
 
-    @cache_method
+    def invalidate_cache(self, *names):
+        invalidate_cached_methods(self, names)
+
+    @cache_method(ttl=300)
     def get_label(self):
         return self.backend.get_label(self)
 
@@ -86,3 +145,39 @@ class Light(object):
 
     def fade_color(self, color, ms):
         return self.backend.fade_color(self, color, ms)
+
+    def get_state(self):
+        return self.backend.get_state(self)
+
+
+class LightGroup(object):
+    def __init__(self, backend, lights):
+        self.backend = backend
+        self.lights = list(lights)
+
+    def __iter__(self):
+        return iter(self.lights)
+
+    def __len__(self):
+        return len(self.lights)
+
+    def get_power(self, as_completed=False):
+        return self.backend.get_power_many(self.lights, as_completed)
+
+    def set_power(self, power, as_completed=False):
+        return self.backend.set_power_many(self.lights, power, as_completed)
+
+    def poweron(self, as_completed=False):
+        return self.set_power(LightPower.ON, as_completed)
+
+    def poweroff(self, as_completed=False):
+        return self.set_power(LightPower.OFF, as_completed)
+
+    def get_color(self, as_completed=False):
+        return self.backend.get_color_many(self.lights, as_completed)
+
+    def set_color(self, color, as_completed=False):
+        return self.backend.set_color_many(self.lights, color, as_completed)
+
+    def fade_color(self, color, ms, as_completed=False):
+        return self.backend.fade_color_many(self.lights, color, ms, as_completed)
@@ -0,0 +1,171 @@
+import colorsys
+import numbers
+import sys
+from array import array
+
+from .base import LightColor, LightWhite
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# All functions take many colors at once and return packed HSBK values, a flat array of
+# unsigned 16 bit hue, saturation, brightness and kelvin values for one color after the
+# other. With NumPy installed that is a numpy.uint16 array, otherwise an array('H').
+
+
+def _kelvins(kelvin, count):
+    if isinstance(kelvin, numbers.Integral):
+        return [kelvin] * count
+    kelvin = list(kelvin)
+    if len(kelvin) != count:
+        raise ValueError('need one kelvin value per color')
+    return kelvin
+
+
+def _pack(h, s, b, k):
+    # h, s and b are floats between 0 and 1
+    if numpy is not None:
+        hsbk = numpy.empty((len(h), 4), dtype=numpy.uint16)
+        hsbk[:, 0] = numpy.asarray(h, dtype=float) * 65535
+        hsbk[:, 1] = numpy.asarray(s, dtype=float) * 65535
+        hsbk[:, 2] = numpy.asarray(b, dtype=float) * 65535
+        hsbk[:, 3] = k
+        return hsbk.ravel()
+    hsbk = array('H')
+    for hue, sat, bri, kelvin in zip(h, s, b, k):
+        hsbk.extend((int(hue * 65535), int(sat * 65535), int(bri * 65535), kelvin))
+    return hsbk
+
+
+def _unpack(hsbk):
+    # returns h, s and b as floats between 0 and 1 and k
+    if numpy is not None:
+        hsbk = numpy.asarray(hsbk, dtype=numpy.uint16).reshape(-1, 4)
+        return hsbk[:, 0] / 65535, hsbk[:, 1] / 65535, hsbk[:, 2] / 65535, hsbk[:, 3]
+    values = list(hsbk)
+    if len(values) % 4 != 0:
+        raise ValueError('HSBK values must come in groups of four')
+    return (
+        [h / 65535 for h in values[0::4]], [s / 65535 for s in values[1::4]],
+        [b / 65535 for b in values[2::4]], values[3::4],
+    )
+
+
+def _rgb_to_hsv(rgb):
+    if numpy is not None:
+        rgb = numpy.asarray(rgb, dtype=float).reshape(-1, 3) / 255
+        r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+        maxc = rgb.max(axis=1)
+        minc = rgb.min(axis=1)
+        delta = maxc - minc
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            s = numpy.where(maxc > 0, delta / maxc, 0)
+            rc = (maxc - r) / delta
+            gc = (maxc - g) / delta
+            bc = (maxc - b) / delta
+            h = numpy.where(
+                r == maxc, bc - gc, numpy.where(g == maxc, 2 + rc - bc, 4 + gc - rc)
+            )
+        h = numpy.where(delta > 0, (h / 6) % 1, 0)
+        return h, s, maxc
+    rgb = list(rgb)
+    if rgb and isinstance(rgb[0], numbers.Number):
+        # a flat array of three values per color like the NumPy path accepts
+        if len(rgb) % 3 != 0:
+            raise ValueError('RGB values must come in groups of three')
+        rgb = zip(rgb[0::3], rgb[1::3], rgb[2::3])
+    hsv = [colorsys.rgb_to_hsv(r / 255, g / 255, b / 255) for r, g, b in rgb]
+    return [c[0] for c in hsv], [c[1] for c in hsv], [c[2] for c in hsv]
+
+
+def _hsv_to_rgb(h, s, v):
+    if numpy is not None:
+        i = numpy.floor(h * 6)
+        f = h * 6 - i
+        i = i.astype(int) % 6
+        p = v * (1 - s)
+        q = v * (1 - s * f)
+        t = v * (1 - s * (1 - f))
+        rgb = numpy.empty((len(h), 3))
+        rgb[:, 0] = numpy.choose(i, [v, q, p, p, t, v])
+        rgb[:, 1] = numpy.choose(i, [t, v, v, q, p, p])
+        rgb[:, 2] = numpy.choose(i, [p, p, t, v, v, q])
+        return numpy.rint(rgb * 255).astype(numpy.uint8)
+    return [
+        tuple(round(c * 255) for c in colorsys.hsv_to_rgb(*hsv)) for hsv in zip(h, s, v)
+    ]
+
+
+def rgb_to_hsbk(rgb, kelvin=3500):
+    # rgb is a sequence of (r, g, b) tuples with values from 0 to 255 or an array with
+    # three of those values per color, kelvin is one value for all colors or one per color
+    h, s, b = _rgb_to_hsv(rgb)
+    return _pack(h, s, b, _kelvins(kelvin, len(h)))
+
+
+def hsb_to_hsbk(hsb, kelvin=3500):
+    # hsb is a sequence of (hue, saturation, brightness) tuples like LightColor
+    if numpy is not None:
+        hsb = numpy.asarray(hsb, dtype=float).reshape(-1, 3)
+        h, s, b = hsb[:, 0] / 360, hsb[:, 1], hsb[:, 2]
+    else:
+        hsb = list(hsb)
+        h, s, b = [c[0] / 360 for c in hsb], [c[1] for c in hsb], [c[2] for c in hsb]
+    return _pack(h, s, b, _kelvins(kelvin, len(h)))
+
+
+def colors_to_hsbk(colors):
+    # converts LightColor and LightWhite values like LifxBackend.set_color does
+    h, s, b, k = [], [], [], []
+    for color in colors:
+        if isinstance(color, LightColor):
+            h.append(color.hue / 360)
+            s.append(color.saturation)
+            b.append(color.brightness)
+            k.append(3500)
+        else:
+            h.append(0)
+            s.append(0)
+            b.append(color.brightness)
+            k.append(color.kelvin)
+    return _pack(h, s, b, k)
+
+
+def hsbk_to_rgb(hsbk):
+    # returns one (r, g, b) tuple per color, or an array of shape (n, 3) with NumPy
+    h, s, b, k = _unpack(hsbk)
+    return _hsv_to_rgb(h, s, b)
+
+
+def hsbk_to_hsb(hsbk):
+    # returns one (hue, saturation, brightness) tuple per color, or an array of shape
+    # (n, 3) with NumPy
+    h, s, b, k = _unpack(hsbk)
+    if numpy is not None:
+        return numpy.stack([h * 360, s, b], axis=1)
+    return [(hue * 360, sat, bri) for hue, sat, bri in zip(h, s, b)]
+
+
+def hsbk_to_colors(hsbk):
+    # returns LightColor and LightWhite values like LifxBackend.get_color does
+    colors = []
+    for hue, sat, bri, kelvin in zip(*_unpack(hsbk)):
+        if sat == 0:
+            colors.append(LightWhite(float(bri), int(kelvin)))
+        else:
+            colors.append(LightColor(float(hue * 360), float(sat), float(bri)))
+    return colors
+
+
+def hsbk_to_bytes(hsbk):
+    # the little endian wire format of the colors, 8 bytes per color like the HSBK field
+    if numpy is not None:
+        return numpy.asarray(hsbk, dtype='<u2').tobytes()
+    if not isinstance(hsbk, array) or sys.byteorder == 'big':
+        hsbk = array('H', hsbk)
+    if sys.byteorder == 'big':
+        hsbk.byteswap()
+    return hsbk.tobytes()
@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from .base import Light
+from .exceptions import LichtError
+from .lifx import AckMode
+
+logger = logging.getLogger(__name__)
+
+# fade to color over ms milliseconds
+Keyframe = namedtuple('Keyframe', ['color', 'ms'])
+
+
+class Effect(object):
+    # a timeline of keyframes played on some lights, repeat times or forever if repeat is
+    # None, every keyframe is a single LightSetColor per light and the lights fade to the
+    # color on their own
+    def __init__(self, engine, lights, keyframes, repeat=1):
+        self.engine = engine
+        self.lights = lights
+        self.keyframes = [Keyframe(*keyframe) for keyframe in keyframes]
+        if not self.keyframes:
+            raise ValueError('an effect needs at least one keyframe')
+        self.repeat = repeat
+        self.sent = 0
+        self._done = threading.Event()
+        self._cancelled = False
+        self._index = 0
+        self._round = 0
+        self._color = None
+        self._start = None
+        self._elapsed = 0
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        # the lights stay at whatever color they are fading to
+        self._cancelled = True
+        self._done.set()
+
+    def _advance(self, due):
+        # sends the next keyframe and returns when the one after it is due, or None once
+        # the last fade is over
+        if self._cancelled:
+            return None
+        if self._start is None:
+            self._start = due
+        if self.repeat is not None and self._round >= self.repeat:
+            self._done.set()
+            return None
+
+        color, ms = self.keyframes[self._index]
+        # holding the same color needs no packet
+        if color != self._color:
+            self.engine.backend.fade_color_many(self.lights, color, ms, ack_mode=AckMode.NONE)
+            self._color = color
+            self.sent += len(self.lights)
+        self._index += 1
+        if self._index == len(self.keyframes):
+            self._index = 0
+            self._round += 1
+        self._elapsed += ms
+        return self._start + self._elapsed / 1000
+
+
+class EffectsEngine(object):
+    # plays any number of effects on a LifxBackend from one timer thread, the due times of
+    # the keyframes are based on the start of an effect so they don't drift
+    def __init__(self, backend):
+        self.backend = backend
+        self._due = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def play(self, lights, keyframes, repeat=1, delay=0):
+        # lights is a light, a LightGroup or any iterable of lights, keyframes are
+        # (color, ms) tuples
+        if isinstance(lights, Light):
+            lights = [lights]
+        effect = Effect(self, list(lights), keyframes, repeat)
+        with self._condition:
+            if self._stopped:
+                raise LichtError('effects engine is stopped')
+            heapq.heappush(self._due, (time.monotonic() + delay, next(self._counter), effect))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='licht-effects')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return effect
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            for due, count, effect in self._due:
+                effect.cancel()
+            self._due = []
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._condition.wait(self._due[0][0] - now if self._due else None)
+                if self._stopped:
+                    return
+                ready = []
+                while self._due and self._due[0][0] <= now:
+                    ready.append(heapq.heappop(self._due))
+
+            for due, count, effect in ready:
+                try:
+                    next_due = effect._advance(due)
+                except LichtError:
+                    effect.cancel()
+                    continue
+                except Exception:
+                    # like a keyframe that can't be encoded, only this effect is stopped
+                    logger.exception('effect %r failed', effect)
+                    effect.cancel()
+                    continue
+                if next_due is not None:
+                    with self._condition:
+                        if self._stopped:
+                            effect.cancel()
+                        else:
+                            heapq.heappush(self._due, (next_due, count, effect))
@@ -1,17 +1,41 @@
+import collections
 import datetime
-import functools
+import heapq
+import logging
+import os
+import queue
 import random
 import socket
+import struct
+import threading
+import time
+from array import array
 from enum import IntEnum
 
-from .base import Backend, Light, LightColor, LightPower, LightWhite
-from .exceptions import LichtTimeoutError
-from .utils import RESERVED, Bitfield, Field, FieldType, cache_method
+from .base import (
+    Backend, Light, LightChange, LightColor, LightGroup, LightPower, LightResult, LightStatus,
+    LightWhite,
+)
+from .exceptions import LichtError, LichtTimeoutError
+from .metrics import Metrics, RequestEvent, RequestOutcome
+from .utils import (
+    RESERVED, Bitfield, Field, FieldType, MethodCache, RttEstimator, cache_method,
+)
 
 
+logger = logging.getLogger(__name__)
+
 LIFX_PORT = 56700
 
 
+# offsets of fields that are patched into cached header templates
+_SIZE_FIELD = struct.Struct('<H')
+_SEQUENCE_OFFSET = 23
+# source, sequence and message type of a packet, read without decoding the Header
+_HEADER_PEEK = struct.Struct('<4x4s15xB8xH')
+_TARGET_SLICE = slice(8, 16)
+
+
 class MessageType(IntEnum):
     GetService = 2
     StateService = 3
@@ -46,6 +70,12 @@ class MessageType(IntEnum):
     LightGetPower = 116
     LightSetPower = 117
     LightStatePower = 118
+    SetExtendedColorZones = 510
+    GetExtendedColorZones = 511
+    StateExtendedColorZones = 512
+    Get64 = 707
+    State64 = 711
+    Set64 = 715
 
     def register(self, cls):
         cls.message_type = self
@@ -256,56 +286,519 @@ class LightState(Bitfield):
     ]
 
 
-def with_socket(meth):
-    @functools.wraps(meth)
-    def wrapper(self, *args, **kwargs):
-        with self._get_socket() as sock:
-            return meth(self, sock, *args, **kwargs)
+# the most zones that fit into one extended multizone packet and the pixels of one tile
+MAX_ZONES = 82
+TILE_PIXELS = 64
+
+
+class ZoneApply(IntEnum):
+    NO_APPLY = 0
+    APPLY = 1
+    APPLY_ONLY = 2
+
+
+@MessageType.SetExtendedColorZones.register
+class SetExtendedColorZones(Bitfield):
+    fields = [
+        Field('duration', 32, FieldType.uint),
+        Field('apply', 8, FieldType.uint),
+        Field('index', 16, FieldType.uint),
+        Field('colors_count', 8, FieldType.uint),
+        Field('colors', type=HSBK, count=MAX_ZONES, length='colors_count'),
+    ]
+
+
+@MessageType.StateExtendedColorZones.register
+class StateExtendedColorZones(Bitfield):
+    fields = [
+        Field('count', 16, FieldType.uint),
+        Field('index', 16, FieldType.uint),
+        Field('colors_count', 8, FieldType.uint),
+        Field('colors', type=HSBK, count=MAX_ZONES, length='colors_count'),
+    ]
+
+
+@MessageType.Get64.register
+class Get64(Bitfield):
+    fields = [
+        Field('tile_index', 8, FieldType.uint),
+        Field('length', 8, FieldType.uint),
+        Field(RESERVED, 8),
+        Field('x', 8, FieldType.uint),
+        Field('y', 8, FieldType.uint),
+        Field('width', 8, FieldType.uint),
+    ]
+
+
+@MessageType.State64.register
+class State64(Bitfield):
+    fields = [
+        Field('tile_index', 8, FieldType.uint),
+        Field(RESERVED, 8),
+        Field('x', 8, FieldType.uint),
+        Field('y', 8, FieldType.uint),
+        Field('width', 8, FieldType.uint),
+        Field('colors', type=HSBK, count=TILE_PIXELS),
+    ]
+
 
-    return wrapper
+@MessageType.Set64.register
+class Set64(Bitfield):
+    fields = [
+        Field('tile_index', 8, FieldType.uint),
+        Field('length', 8, FieldType.uint),
+        Field(RESERVED, 8),
+        Field('x', 8, FieldType.uint),
+        Field('y', 8, FieldType.uint),
+        Field('width', 8, FieldType.uint),
+        Field('duration', 32, FieldType.uint),
+        Field('colors', type=HSBK, count=TILE_PIXELS),
+    ]
 
 
-class LifxBackend(Backend):
-    def __init__(self, source_id=b'lcht', timeout=3, tries=3):
+class _ResponseRouter(object):
+    # assigns a unique (source, sequence) pair to every request in flight and routes
+    # incoming packets to the callback of the matching request
+    def __init__(self, source_id):
+        self.sources = [source_id]
+        self._callbacks = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def register(self, callback):
+        with self._lock:
+            num_keys = len(self.sources) * 256
+            for _ in range(num_keys):
+                key = self._next_key % num_keys
+                self._next_key = key + 1
+                source, seq = self.sources[key // 256], key % 256
+                if (source, seq) not in self._callbacks:
+                    break
+            else:
+                # all sequence numbers are in use, continue with a new source
+                source, seq = os.urandom(4), 0
+                self.sources.append(source)
+                self._next_key = num_keys + 1
+            self._callbacks[source, seq] = callback
+            return source, seq
+
+    def unregister(self, source, seq):
+        with self._lock:
+            self._callbacks.pop((source, seq), None)
+
+    def route(self, data, addr):
+        if len(data) < Header.total_bytes:
+            return
+        source, seq, msg_type = _HEADER_PEEK.unpack_from(data)
+        callback = self._callbacks.get((source, seq))
+        if callback is not None:
+            callback((msg_type, data, addr))
+
+
+class _Discovery(object):
+    # keeps track of the broadcasts, deadlines and lights found while discovering
+    # lights, the whole discovery takes at most timeout seconds, GetService is
+    # broadcast backend.tries times during that time
+    def __init__(self, backend, timeout=None, count=None, quiet=None):
+        if timeout is None:
+            timeout = backend.timeout
+        self.backend = backend
+        self.count = count
+        self.quiet = quiet
+        self.light_addrs = set()
+
+        now = time.monotonic()
+        self.deadline = now + timeout
+        self.last_found = now
+        self.interval = timeout / backend.tries
+        self.next_broadcast = now
+        self.broadcasts = backend.tries
+
+    def poll(self):
+        # returns whether to broadcast now and how long to wait for responses,
+        # the time to wait is None once the discovery is done
+        now = time.monotonic()
+        stop = self.deadline
+        if self.quiet is not None:
+            stop = min(stop, self.last_found + self.quiet)
+        if now >= stop or (self.count is not None and len(self.light_addrs) >= self.count):
+            return False, None
+
+        broadcast = False
+        if self.broadcasts and now >= self.next_broadcast:
+            broadcast = True
+            self.broadcasts -= 1
+            self.next_broadcast += self.interval
+        if self.broadcasts:
+            stop = min(stop, self.next_broadcast)
+        return broadcast, max(stop - now, 0)
+
+    def add(self, data, host):
+        # returns the address of the light if it was found for the first time
+        response = self.backend._parse_response(data, MessageType.StateService)
+        if response is None:
+            return None
+        header, service = response
+        addr = (host, service['port'], header['frame_address']['target'])
+        if addr in self.light_addrs:
+            return None
+        self.light_addrs.add(addr)
+        self.last_found = time.monotonic()
+        return addr
+
+
+# states that are cached and the writes that make them stale
+_CACHED_STATES = frozenset([MessageType.StatePower, MessageType.StateLabel, MessageType.LightState])
+_STALE_STATES = {
+    MessageType.SetPower: 'power', MessageType.LightSetColor: 'color',
+    MessageType.SetExtendedColorZones: 'color', MessageType.Set64: 'color',
+}
+
+
+class AckMode(IntEnum):
+    # set operations either don't wait for anything, wait for the acknowledgement and return
+    # the requested value, or wait for the state of the light and return that
+    NONE = 0
+    ACK = 1
+    STATE = 2
+
+
+class BaseLifxBackend(Backend):
+    # encoded headers are cached per target, message type and flags
+    max_header_cache_size = 4096
+    broadcast_addr = ('<broadcast>', LIFX_PORT)
+    # retransmission timeouts before the first and lowest possible after some round trips
+    initial_rto = 0.5
+    min_rto = 0.1
+
+    def __init__(
+        self, source_id=b'lcht', timeout=3, tries=3, ack_mode=AckMode.STATE, state_ttl=None
+    ):
         self.source_id = source_id
-        self.timeout = 3
-        self.tries = 3
+        # timeout is the deadline for a whole request including all of its retries
+        self.timeout = timeout
+        self.tries = tries
+        self.ack_mode = ack_mode
+        # power, color and label from every response are cached for state_ttl seconds
+        self.state_ttl = state_ttl
+        self._header_cache = {}
+        self._router = _ResponseRouter(source_id)
+        self._rtt_estimators = {}
+        self._states = {}
+        # the one light object for every device target
+        self._lights = {}
+        self._lights_lock = threading.Lock()
+
+    def _make_light(self, addr):
+        return LifxLight(self, addr)
 
-    @staticmethod
-    def _make_packet(source_id, target_addr, seq, payload, ack=False, res=False):
-        if target_addr is None:
-            target_addr = b'\x00'
-            tagged = 1
+    def _register_light(self, addr):
+        # returns the light object for the device at addr and moves it to addr if its host or
+        # port changed
+        target_addr = addr[2]
+        with self._lights_lock:
+            light = self._lights.get(target_addr)
+            if light is None:
+                light = self._lights[target_addr] = self._make_light(addr)
+            elif light.addr != addr:
+                light.addr = addr
+        return light
+
+    def get_known_lights(self):
+        with self._lights_lock:
+            return list(self._lights.values())
+
+    def _cache_state(self, msg_type, data, packet):
+        # packet is the state that the handler of a request already parsed from data
+        if self.state_ttl is None or msg_type not in _CACHED_STATES:
+            return
+        target = bytes(data[_TARGET_SLICE])
+        expires = time.monotonic() + self.state_ttl
+        if msg_type is MessageType.StatePower:
+            self._states[target, 'power'] = expires, self._parse_power(packet['level'])
         else:
-            tagged = 0
+            if msg_type is MessageType.LightState:
+                self._states[target, 'power'] = expires, self._parse_power(packet['power'])
+                self._states[target, 'color'] = expires, self._to_color(packet['color'])
+            # labels are only decoded when they are read, replies to requests that don't ask
+            # for the label must not fail on a label that isn't valid UTF-8
+            self._states[target, 'label'] = expires, bytes(packet['label'])
+
+    def _get_cached_state(self, addr, name):
+        if self.state_ttl is not None:
+            entry = self._states.get((addr[2], name))
+            if entry is not None and entry[0] > time.monotonic():
+                if name == 'label':
+                    return self._convert_string(entry[1])
+                return entry[1]
+
+    def _get_cached_status(self, addr):
+        power = self._get_cached_state(addr, 'power')
+        color = self._get_cached_state(addr, 'color')
+        label = self._get_cached_state(addr, 'label')
+        if power is not None and color is not None and label is not None:
+            return LightStatus(power, color, label)
+
+    def clear_state_cache(self):
+        self._states.clear()
+
+    @staticmethod
+    def _device_key(addr):
+        host, port, target_addr = addr
+        return (host, port) if target_addr is None else target_addr
+
+    def _get_rtt_estimator(self, addr):
+        key = self._device_key(addr)
+        estimator = self._rtt_estimators.get(key)
+        if estimator is None:
+            estimator = self._rtt_estimators.setdefault(
+                key, RttEstimator(self.initial_rto, self.min_rto, self.timeout)
+            )
+        return estimator
+
+    @staticmethod
+    def _split_payload(payload):
         if isinstance(payload, MessageType):
-            msg_type = payload
-            payload = b''
+            return payload, None
         elif isinstance(payload, Bitfield):
-            msg_type = payload.message_type
-            payload = payload.to_bytes()
+            return payload.message_type, payload
         else:
             raise ValueError('payload must be MessageType or Bitfield')
-        frame = Frame(0, 0, tagged, 1, 1024, source_id)
-        faddr = FrameAddress(target_addr, int(ack), int(res), seq)
-        header = ProtocolHeader(int(msg_type))
 
-        size = frame.total_bytes + faddr.total_bytes + header.total_bytes + len(payload)
-        frame['size'] = size
-
-        return frame.to_bytes() + faddr.to_bytes() + header.to_bytes() + payload
+    def _get_header_template(self, source, target_addr, msg_type, ack, res):
+        key = source, target_addr, msg_type, ack, res
+        template = self._header_cache.get(key)
+        if template is None:
+            if target_addr is None:
+                target_addr = b'\x00'
+                tagged = 1
+            else:
+                tagged = 0
+            template = Header(
+                Frame(Header.total_bytes, 0, tagged, 1, 1024, source),
+                FrameAddress(target_addr, int(ack), int(res), 0),
+                ProtocolHeader(int(msg_type)),
+            ).to_bytes()
+            if len(self._header_cache) >= self.max_header_cache_size:
+                self._header_cache.clear()
+            self._header_cache[key] = template
+        return template
+
+    def _pack_packet(self, buffer, offset, source, target_addr, seq, msg_type, payload, ack, res):
+        template = self._get_header_template(source, target_addr, msg_type, bool(ack), bool(res))
+        size = Header.total_bytes
+        buffer[offset:offset + size] = template
+        if payload is not None:
+            payload.pack_into(buffer, offset + size)
+            size += payload.total_bytes
+            _SIZE_FIELD.pack_into(buffer, offset, size)
+        buffer[offset + _SEQUENCE_OFFSET] = seq
+        return size
+
+    def _make_packet(self, target_addr, seq, payload, ack=False, res=False, source=None):
+        if source is None:
+            source = self.source_id
+        msg_type, payload = self._split_payload(payload)
+        size = Header.total_bytes
+        if payload is not None:
+            size += payload.total_bytes
+        packet = bytearray(size)
+        self._pack_packet(packet, 0, source, target_addr, seq, msg_type, payload, ack, res)
+        return packet
+
+    def _make_packets(self, packets, ack=False, res=False, source=None):
+        # encodes (target_addr, seq, payload) tuples into a single buffer and returns
+        # a memoryview of every packet in it
+        if source is None:
+            source = self.source_id
+        packets = [
+            (target_addr, seq) + self._split_payload(payload)
+            for target_addr, seq, payload in packets
+        ]
+        total_size = sum(
+            Header.total_bytes + (0 if payload is None else payload.total_bytes)
+            for _, _, _, payload in packets
+        )
+        buffer = bytearray(total_size)
+        view = memoryview(buffer)
+        offset = 0
+        result = []
+        for target_addr, seq, msg_type, payload in packets:
+            size = self._pack_packet(
+                buffer, offset, source, target_addr, seq, msg_type, payload, ack, res
+            )
+            result.append(view[offset:offset + size])
+            offset += size
+        return result
 
     @staticmethod
     def _parse_response(data, expected_type):
-        header = Header.from_bytes(data)
-        if header.payload_type is not expected_type:
-            return None
-        response = data[Header.total_bytes:]
         try:
-            return header, expected_type.get_bitfield().from_bytes(response)
+            header = Header.view(data)
+            if header.payload_type is not expected_type:
+                return None
+            return header, expected_type.get_bitfield().view(data, Header.total_bytes)
         except ValueError:
             return None
 
+    def _state_request(self, addr, get_type, state_type):
+        return addr, get_type, self._state_handler(state_type), False, False
+
+    def _set_request(self, addr, set_packet, state_type=None, ack_mode=None):
+        if ack_mode is None:
+            ack_mode = self.ack_mode
+        stale = _STALE_STATES.get(set_packet.message_type)
+        if stale is not None:
+            self._states.pop((addr[2], stale), None)
+        if ack_mode is AckMode.NONE:
+            # requests without a handler are done as soon as they are sent
+            return addr, set_packet, None, False, False
+        elif ack_mode is AckMode.ACK:
+            state_type = None
+        res = state_type is not None
+        return addr, set_packet, self._set_handler(state_type), True, res
+
+    def _set_result(self, ack_mode, state, requested, convert):
+        if ack_mode is None:
+            ack_mode = self.ack_mode
+        if ack_mode is AckMode.NONE:
+            return None
+        elif ack_mode is AckMode.ACK:
+            return requested
+        else:
+            return convert(state)
+
+    def _state_handler(self, state_type):
+        def handle(msg_type, data):
+            if msg_type == state_type:
+                response = self._parse_response(data, state_type)
+                if response is not None:
+                    self._cache_state(state_type, data, response[1])
+                return response
+
+        return handle
+
+    def _echo_handler(self, payload):
+        def handle(msg_type, data):
+            if msg_type == MessageType.EchoResponse:
+                response = self._parse_response(data, MessageType.EchoResponse)
+                if response is not None and response[1]['payload'] == payload:
+                    return True
+
+        return handle
+
+    def _set_handler(self, state_type):
+        # the handler returns a one element list with the state packet, or None if
+        # state_type is None, once the acknowledgement and the state have arrived
+        result = []
+        acked = []
+
+        def handle(msg_type, data):
+            if msg_type == MessageType.Acknowledgement:
+                acked.append(True)
+            elif state_type is not None and msg_type == state_type and not result:
+                response = self._parse_response(data, state_type)
+                if response is not None:
+                    result.append(response[1])
+                    self._cache_state(state_type, data, result[0])
+
+            if acked and (state_type is None or result):
+                return result or [None]
+
+        return handle
+
+    @staticmethod
+    def _zones_handler():
+        # strips with more zones than fit into one packet answer with several states, the
+        # handler returns the packed HSBK values of all zones once they have arrived
+        zones = {}
+
+        def handle(msg_type, data):
+            state_type = MessageType.StateExtendedColorZones
+            if msg_type != state_type:
+                return None
+            response = BaseLifxBackend._parse_response(data, state_type)
+            if response is None:
+                return None
+            state = response[1]
+            zones[state['index']] = state['colors']
+            count = state['count']
+            if sum(len(colors) for colors in zones.values()) >= 4 * count:
+                hsbk = array('H')
+                for index in sorted(zones):
+                    hsbk.extend(zones[index])
+                return hsbk[:4 * count]
+
+        return handle
+
+    def _set_zones_handler(self):
+        # like the set handler, but waits for the acknowledgement and the states of all zones
+        # of the strip and returns a one element list with their packed HSBK values
+        zones = self._zones_handler()
+        result = []
+        acked = []
+
+        def handle(msg_type, data):
+            if msg_type == MessageType.Acknowledgement:
+                acked.append(True)
+            elif not result:
+                hsbk = zones(msg_type, data)
+                if hsbk is not None:
+                    result.append(hsbk)
+
+            if acked and result:
+                return result
+
+        return handle
+
+    @staticmethod
+    def _hsbk_array(hsbk, max_colors=None):
+        # packed HSBK values as returned by the functions in licht.colors
+        if not isinstance(hsbk, array) or hsbk.typecode != 'H':
+            hsbk = array('H', hsbk.tolist() if hasattr(hsbk, 'tolist') else hsbk)
+        if len(hsbk) % 4 != 0:
+            raise ValueError('HSBK values must come in groups of four')
+        if max_colors is not None and len(hsbk) > 4 * max_colors:
+            raise ValueError('at most {} colors fit into one packet'.format(max_colors))
+        return hsbk
+
+    def _zones_packet(self, hsbk, ms, index):
+        hsbk = self._hsbk_array(hsbk, MAX_ZONES)
+        return SetExtendedColorZones(ms, ZoneApply.APPLY, index, len(hsbk) // 4, hsbk)
+
+    def _zones_requests(self, addr, hsbk, ms, index, ack_mode):
+        # returns one set request for every MAX_ZONES zones and the packed HSBK values of all
+        # of them, they have to be sent one after another, with AckMode.STATE the last request
+        # waits for the states of the whole strip and the others for their acknowledgement
+        if ack_mode is None:
+            ack_mode = self.ack_mode
+        hsbk = self._hsbk_array(hsbk)
+        step = 4 * MAX_ZONES
+        requests = [
+            self._set_request(
+                addr, self._zones_packet(hsbk[start:start + step], ms, index + start // 4), None,
+                AckMode.ACK if ack_mode is AckMode.STATE else ack_mode,
+            )
+            for start in range(0, len(hsbk) or 1, step)
+        ]
+        if ack_mode is AckMode.STATE:
+            requests[-1] = requests[-1][:2] + (self._set_zones_handler(), True, True)
+        return requests, hsbk
+
+    def _tile_packet(self, hsbk, tile_index, ms, x, y, width):
+        hsbk = self._hsbk_array(hsbk, TILE_PIXELS)
+        return Set64(tile_index, 1, x, y, width, ms, hsbk)
+
+    def _tile_ack_mode(self, ack_mode):
+        # devices never answer Set64 with a state, an acknowledgement is all there is
+        if ack_mode is None:
+            ack_mode = self.ack_mode
+        return AckMode.ACK if ack_mode is AckMode.STATE else ack_mode
+
+    @staticmethod
+    def _zones_from_state(response):
+        return response[0]
+
     @staticmethod
     def _convert_datetime(src_ns):
         return datetime.datetime.utcfromtimestamp(src_ns // 10**9)
@@ -332,56 +825,613 @@ class LifxBackend(Backend):
             b = b / 65535
             return LightColor(h, s, b)
 
-    def _get_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(self.timeout)
-        return sock
+    @classmethod
+    def _parse_label(cls, label):
+        return cls._convert_string(label['label'])
 
-    def discover_lights(self):
-        with self._get_socket() as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-            sock.bind(('0.0.0.0', LIFX_PORT))
+    @staticmethod
+    def _parse_device_info(info):
+        return info['signal'], info['tx'], info['rx']
 
-            broadcast_addr = ('<broadcast>', LIFX_PORT)
+    @classmethod
+    def _parse_firmware(cls, firmware):
+        version = firmware['version']
+        build = cls._convert_datetime(firmware['build'])
+        major = version >> 16
+        minor = version & 0xff
+        return build, major, minor
 
-            light_addrs = set()
+    @staticmethod
+    def _parse_version(version):
+        return version['vendor'], version['product'], version['version']
+
+    @classmethod
+    def _parse_info(cls, info):
+        time = cls._convert_datetime(info['time'])
+        uptime = cls._convert_timedelta(info['uptime'])
+        downtime = cls._convert_timedelta(info['downtime'])
+        return time, uptime, downtime
+
+    @classmethod
+    def _parse_location(cls, loc):
+        label = cls._convert_string(loc['label'])
+        updated_at = cls._convert_datetime(loc['updated_at'])
+        return loc['location'], label, updated_at
+
+    @classmethod
+    def _parse_group(cls, group):
+        label = cls._convert_string(group['label'])
+        updated_at = cls._convert_datetime(group['updated_at'])
+        return group['group'], label, updated_at
+
+    @staticmethod
+    def _parse_power(level):
+        if level == 0:
+            return LightPower.OFF
+        else:
+            return LightPower.ON
+
+    @staticmethod
+    def _power_to_level(power):
+        if power is LightPower.OFF:
+            return 0
+        else:
+            return 65535
 
-            for i in range(self.tries):
-                sock.sendto(
-                    self._make_packet(self.source_id, None, i, MessageType.GetService),
-                    broadcast_addr
+    @staticmethod
+    def _color_to_hsbk(color):
+        if isinstance(color, LightColor):
+            h, s, b = color
+            h = int(h * 65535 / 360)
+            s = int(s * 65535)
+            b = int(b * 65535)
+            return h, s, b, 3500
+        else:
+            b, k = color
+            b = int(b * 65535)
+            return 0, 0, b, k
+
+    @staticmethod
+    def _make_echo_payload():
+        return bytes([random.getrandbits(8) for _ in range(EchoRequest.total_bytes)])
+
+    @staticmethod
+    def _power_from_state(state):
+        return BaseLifxBackend._parse_power(state['level'])
+
+    @staticmethod
+    def _color_from_state(state):
+        return BaseLifxBackend._to_color(state['color'])
+
+    @classmethod
+    def _status_from_state(cls, state):
+        return LightStatus(
+            cls._parse_power(state['power']), cls._to_color(state['color']),
+            cls._parse_label(state),
+        )
+
+    def set_color(self, light, color, ack_mode=None):
+        return self.fade_color(light, color, 0, ack_mode)
+
+    def set_color_many(self, lights, color, as_completed=False, ack_mode=None):
+        return self.fade_color_many(lights, color, 0, as_completed, ack_mode)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+# writes of these types replace queued writes of the same type to the same light, requests
+# without a payload replace identical queued requests
+_COALESCED_MESSAGES = frozenset([MessageType.SetPower, MessageType.LightSetColor])
+
+
+class _PendingRequest(object):
+    __slots__ = (
+        'key', 'device', 'addr', 'packet', 'handle', 'coalesce_key', 'listeners', 'tries',
+        'rtt', 'attempts', 'sent', 'deadline', 'final_deadline', 'queued', 'superseded_by',
+    )
+
+    def __init__(self, device, addr, handle, coalesce_key, tries, rtt, final_deadline):
+        self.key = None
+        self.device = device
+        self.addr = addr
+        self.packet = None
+        self.handle = handle
+        self.coalesce_key = coalesce_key
+        self.listeners = []
+        self.tries = tries
+        self.rtt = rtt
+        self.attempts = 0
+        self.sent = None
+        self.deadline = None
+        self.final_deadline = final_deadline
+        self.queued = False
+        self.superseded_by = None
+
+    def deliver(self, response):
+        for listener in self.listeners:
+            listener(response)
+
+
+class _DeviceQueue(object):
+    __slots__ = ('queues', 'tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.queues = tuple(collections.deque() for _ in Priority)
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, now, rate, burst):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def pop(self):
+        for requests in self.queues:
+            if requests:
+                return requests.popleft()
+
+
+class _SendScheduler(object):
+    # paces the packets sent to every device with a token bucket, interactive requests
+    # are sent before background requests
+    def __init__(self, sock, rate, burst):
+        self.sock = sock
+        self.rate = rate
+        self.burst = burst
+        self.devices = {}
+        self.waiting = set()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _transmit(self, request, now):
+        request.attempts += 1
+        request.sent = now
+        try:
+            self.sock.sendto(request.packet, request.addr)
+        except OSError as e:
+            return e
+
+    def _coalesce(self, device, request, priority):
+        for queued_priority, requests in zip(Priority, device.queues):
+            for i, queued in enumerate(requests):
+                if queued.coalesce_key == request.coalesce_key:
+                    # the newer request takes over the place and the listeners of the old one,
+                    # unless it has a higher priority and goes to the end of its own queue
+                    if priority < queued_priority:
+                        del requests[i]
+                        device.queues[priority].append(request)
+                    else:
+                        requests[i] = request
+                    request.queued = True
+                    request.listeners.extend(queued.listeners)
+                    queued.queued = False
+                    queued.superseded_by = request
+                    return True
+        return False
+
+    def send(self, request, priority=Priority.INTERACTIVE):
+        # sends the request or queues it until the device may receive more packets, returns
+        # an OSError if sending failed right away
+        with self.condition:
+            if request.queued or request.superseded_by is not None:
+                return
+            request.tries -= 1
+            now = time.monotonic()
+            device = self.devices.get(request.device)
+            if device is None:
+                device = self.devices[request.device] = _DeviceQueue(self.burst, now)
+            else:
+                device.refill(now, self.rate, self.burst)
+
+            if request.coalesce_key is not None and self._coalesce(device, request, priority):
+                return
+            if device.tokens >= 1 and not any(device.queues):
+                device.tokens -= 1
+                return self._transmit(request, now)
+            device.queues[priority].append(request)
+            request.queued = True
+            self.waiting.add(request.device)
+            self.condition.notify()
+
+    def cancel(self, request):
+        with self.condition:
+            if request.queued:
+                request.queued = False
+                for requests in self.devices[request.device].queues:
+                    if request in requests:
+                        requests.remove(request)
+
+    def _send_ready(self, now):
+        # sends all queued packets the devices may receive now and returns the time to wait
+        # until the next one, or None if nothing is queued
+        wait = None
+        for key in list(self.waiting):
+            device = self.devices[key]
+            device.refill(now, self.rate, self.burst)
+            while device.tokens >= 1:
+                request = device.pop()
+                if request is None:
+                    break
+                device.tokens -= 1
+                request.queued = False
+                self._transmit(request, now)
+            if any(device.queues):
+                delay = (1 - device.tokens) / self.rate
+                wait = delay if wait is None else min(wait, delay)
+            else:
+                self.waiting.discard(key)
+        return wait
+
+    def run(self):
+        with self.condition:
+            while not self.closed:
+                self.condition.wait(self._send_ready(time.monotonic()))
+
+
+class LifxBackend(BaseLifxBackend):
+    # LIFX devices drop packets if they receive more than about 20 per second
+    send_rate = 20
+    send_burst = 5
+
+    def __init__(
+        self, source_id=b'lcht', timeout=3, tries=3, ack_mode=AckMode.STATE, state_ttl=None,
+        observer=None,
+    ):
+        super().__init__(source_id, timeout, tries, ack_mode, state_ttl)
+        # called with a RequestEvent for every finished request
+        self.observer = observer
+        self.metrics = None
+        # measure the time spent encoding and decoding packets for the events
+        self.spans = False
+        self._sock = None
+        self._scheduler = None
+        self._sock_lock = threading.Lock()
+        self._closed = False
+
+    def enable_metrics(self, spans=False):
+        # keeps counters and histograms of all requests per message type and per light
+        self.metrics = Metrics()
+        self.spans = spans
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self.spans = False
+
+    def _report(self, info, request, outcome, now):
+        # info is the [msg_type, target, started, encode_time, bytes_received, decode_time]
+        # of the request
+        msg_type, target, started, encode_time, received, decode_time = info
+        attempts = request.attempts
+        if outcome is RequestOutcome.SENT:
+            attempts = 1
+        rtt = None
+        if outcome is RequestOutcome.OK and request.sent is not None:
+            rtt = now - request.sent
+        event = RequestEvent(
+            msg_type, target, attempts, rtt, now - started, len(request.packet) * attempts,
+            received, outcome, encode_time, decode_time,
+        )
+        if self.metrics is not None:
+            self.metrics(event)
+        if self.observer is not None:
+            try:
+                self.observer(event)
+            except Exception:
+                # the request itself succeeded or failed already, an error of the observer
+                # must not change that
+                logger.exception('request observer failed for %r', event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._sock_lock:
+            self._closed = True
+            sock = self._sock
+            self._sock = None
+            if self._scheduler is not None:
+                self._scheduler.close()
+                self._scheduler = None
+        if sock is not None:
+            # wake up the receiver thread, it closes the socket once it notices
+            try:
+                sock.sendto(b'', ('127.0.0.1', sock.getsockname()[1]))
+            except OSError:
+                sock.close()
+
+    def _get_shared_socket(self):
+        with self._sock_lock:
+            if self._closed:
+                raise LichtError('backend is closed')
+            if self._sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+                sock.bind(('0.0.0.0', 0))
+                thread = threading.Thread(
+                    target=self._receive, args=(sock,), name='licht-lifx-receiver'
                 )
+                thread.daemon = True
+                self._sock = sock
+                thread.start()
+
+                self._scheduler = _SendScheduler(sock, self.send_rate, self.send_burst)
+                thread = threading.Thread(target=self._scheduler.run, name='licht-lifx-sender')
+                thread.daemon = True
+                thread.start()
+            return self._sock
+
+    def _get_scheduler(self):
+        self._get_shared_socket()
+        return self._scheduler
+
+    def _receive(self, sock):
+        route = self._router.route
+        while self._sock is sock:
+            try:
+                data, addr = sock.recvfrom(4096)
+            except OSError:
+                if sock.fileno() == -1:
+                    return
+                continue
+            route(data, addr)
+        sock.close()
+
+    def _run_requests(self, requests, priority=Priority.INTERACTIVE, timeout=None):
+        # sends all (addr, payload, handle, ack, res) requests before it returns and returns
+        # an iterator over (index, result, error) tuples in the order the requests finish
+        if timeout is None:
+            timeout = self.timeout
+        scheduler = self._get_scheduler()
+        responses = queue.Queue()
+        pending = {}
+        deadlines = []
+        # everything for the RequestEvents is only collected if anyone is listening
+        observing = self.observer is not None or self.metrics is not None
+        spans = observing and self.spans
+        infos = {}
+
+        def send(index, request, now):
+            request.deadline = min(
+                now + request.rtt.rto(request.attempts), request.final_deadline
+            )
+            heapq.heappush(deadlines, (request.deadline, index))
+            return scheduler.send(request, priority)
+
+        def finish(index, outcome):
+            request = pending.pop(index)
+            scheduler.cancel(request)
+            self._router.unregister(*request.key)
+            if observing:
+                self._report(infos.pop(index), request, outcome, time.monotonic())
+
+        def make_packet(index, target_addr, seq, payload, ack, res, source=None):
+            if not spans:
+                return self._make_packet(target_addr, seq, payload, ack, res, source)
+            started = time.perf_counter()
+            packet = self._make_packet(target_addr, seq, payload, ack, res, source)
+            infos[index][3] = time.perf_counter() - started
+            return packet
+
+        def cleanup():
+            for request in pending.values():
+                scheduler.cancel(request)
+                self._router.unregister(*request.key)
+
+        # requests that are done as soon as they are sent or that failed to send
+        finished = []
+        try:
+            now = time.monotonic()
+            for index, (addr, payload, handle, ack, res) in enumerate(requests):
+                host, port, target_addr = addr
+                msg_type, body = self._split_payload(payload)
+                coalesce_key = None
+                if body is None or msg_type in _COALESCED_MESSAGES:
+                    coalesce_key = msg_type, ack, res
+                request = _PendingRequest(
+                    self._device_key(addr), (host, port), handle, coalesce_key, self.tries,
+                    self._get_rtt_estimator(addr), now + timeout,
+                )
+                if observing:
+                    infos[index] = [msg_type, target_addr, now, None, 0, None]
+                if handle is None:
+                    # fire and forget, no response will arrive
+                    request.packet = make_packet(index, target_addr, 0, payload, ack, res)
+                    error = scheduler.send(request, priority)
+                    if observing:
+                        outcome = RequestOutcome.SENT if error is None else RequestOutcome.ERROR
+                        self._report(infos.pop(index), request, outcome, time.monotonic())
+                    finished.append((index, None, error))
+                    continue
+                request.listeners.append(
+                    lambda response, index=index: responses.put((index, response))
+                )
+                request.key = self._router.register(request.deliver)
+                request.packet = make_packet(
+                    index, target_addr, request.key[1], payload, ack, res, request.key[0]
+                )
+                pending[index] = request
+                error = send(index, request, now)
+                if error is not None:
+                    finish(index, RequestOutcome.ERROR)
+                    finished.append((index, None, error))
+        except BaseException:
+            cleanup()
+            raise
+
+        def results():
+            try:
+                # runs up to here right away so the requests are cleaned up once the
+                # iterator is closed or garbage collected, even if it is never used
+                yield
+                yield from finished
+                while pending:
+                    now = time.monotonic()
+                    while deadlines and deadlines[0][0] <= now:
+                        deadline, index = heapq.heappop(deadlines)
+                        request = pending.get(index)
+                        if request is None or request.deadline != deadline:
+                            continue
+                        error = None
+                        outcome = RequestOutcome.ERROR
+                        if request.tries > 0 and now < request.final_deadline:
+                            error = send(index, request, now)
+                        else:
+                            error = LichtTimeoutError()
+                            outcome = RequestOutcome.TIMEOUT
+                        if error is not None:
+                            finish(index, outcome)
+                            yield index, None, error
+
+                    if not pending:
+                        break
 
-                while True:
                     try:
-                        data, (host, port) = sock.recvfrom(4096)
-                    except socket.timeout:
-                        break
-                    response = self._parse_response(data, MessageType.StateService)
-                    if response is not None:
-                        header, service = response
-                        addr = (host, service['port'], header['frame_address']['target'])
-                        if addr not in light_addrs:
-                            light_addrs.add(addr)
-                            yield LifxLight(self, addr)
-
-    @with_socket
-    def _get_state_response(self, sock, addr, get_type, state_type):
-        host, port, target_addr = addr
-        for i in range(self.tries):
-            sock.sendto(self._make_packet(self.source_id, target_addr, i, get_type), (host, port))
+                        index, (msg_type, data, addr) = responses.get(
+                            timeout=deadlines[0][0] - now
+                        )
+                    except queue.Empty:
+                        continue
+                    request = pending.get(index)
+                    if request is None:
+                        continue
+                    if spans:
+                        started = time.perf_counter()
+                        result = request.handle(msg_type, data)
+                        info = infos[index]
+                        info[5] = (info[5] or 0) + time.perf_counter() - started
+                        info[4] += len(data)
+                    else:
+                        result = request.handle(msg_type, data)
+                        if observing:
+                            infos[index][4] += len(data)
+                    if result is not None:
+                        # Karn's algorithm: replies to retransmitted packets are ambiguous
+                        if request.attempts == 1:
+                            request.rtt.add_sample(time.monotonic() - request.sent)
+                        finish(index, RequestOutcome.OK)
+                        yield index, result, None
+            finally:
+                cleanup()
+
+        results = results()
+        next(results)
+        return results
+
+    def _request(
+        self, addr, payload, handle, ack=False, res=False, priority=Priority.INTERACTIVE
+    ):
+        requests = [(addr, payload, handle, ack, res)]
+        for index, result, error in self._run_requests(requests, priority):
+            if error is not None:
+                raise error
+            return result
+
+    def _run_requests_many(self, lights, as_completed, make_request, convert, cached=None):
+        # cached returns the cached value for a light's address or None
+        lights = list(lights)
+        indices = []
+        requests = []
+        cached_results = []
+        for index, light in enumerate(lights):
+            value = None if cached is None else cached(light.addr)
+            if value is None:
+                indices.append(index)
+                requests.append(make_request(light.addr))
+            else:
+                cached_results.append((index, LightResult(light, value, None)))
+
+        responses = self._run_requests(requests)
+
+        def results():
+            yield from cached_results
+            for request_index, response, error in responses:
+                index = indices[request_index]
+                if error is None:
+                    yield index, LightResult(lights[index], convert(response), None)
+                else:
+                    yield index, LightResult(lights[index], None, error)
+
+        return self._collect_results(results(), len(lights), as_completed)
+
+    def discover_lights(self, timeout=None, count=None, quiet=None):
+        sock = self._get_shared_socket()
+        responses = queue.Queue()
+        source, seq = self._router.register(responses.put)
+        try:
+            packet = self._make_packet(None, seq, MessageType.GetService, source=source)
+            discovery = _Discovery(self, timeout, count, quiet)
+
             while True:
-                try:
-                    data, from_addr = sock.recvfrom(4096)
-                except socket.timeout:
+                broadcast, wait = discovery.poll()
+                if wait is None:
                     break
-                if from_addr != (host, port):
+                if broadcast:
+                    sock.sendto(packet, self.broadcast_addr)
+                try:
+                    msg_type, data, (host, port) = responses.get(timeout=wait)
+                except queue.Empty:
                     continue
-                response = self._parse_response(data, state_type)
-                if response is not None:
-                    return response
-
-        raise LichtTimeoutError()
+                addr = discovery.add(data, host)
+                if addr is not None:
+                    yield self._register_light(addr)
+        finally:
+            self._router.unregister(source, seq)
+
+    def set_hsbk_many(self, lights, hsbk, ms=0, as_completed=False, ack_mode=None):
+        # sets every light to its own color from packed HSBK values as returned by the
+        # functions in licht.colors, four values per light in the order of lights
+        lights = list(lights)
+        values = hsbk.tolist() if hasattr(hsbk, 'tolist') else list(hsbk)
+        if len(values) != 4 * len(lights):
+            raise ValueError('need four HSBK values per light')
+        packets = [
+            LightSetColor(HSBK._make(tuple(values[i:i + 4])), ms)
+            for i in range(0, len(values), 4)
+        ]
+        requests = [
+            self._set_request(light.addr, packet, MessageType.LightState, ack_mode)
+            for light, packet in zip(lights, packets)
+        ]
+
+        responses = self._run_requests(requests)
+
+        def results():
+            for index, response, error in responses:
+                if error is None:
+                    value = self._set_result(
+                        ack_mode, response and response[0],
+                        self._to_color(packets[index]['color']), self._color_from_state,
+                    )
+                    yield index, LightResult(lights[index], value, None)
+                else:
+                    yield index, LightResult(lights[index], None, error)
+
+        return self._collect_results(results(), len(lights), as_completed)
+
+    def build_index(self, lights=None):
+        # groups and locations of the given lights, or of all known lights
+        index = LightIndex(self)
+        index.refresh(self.get_known_lights() if lights is None else lights)
+        return index
+
+    def poll_lights(self, lights, interval=1, jitter=0.1, callback=None, max_backoff=60):
+        poller = LightPoller(self, lights, interval, jitter, callback, max_backoff)
+        poller.start()
+        return poller
+
+    def _get_state_response(self, addr, get_type, state_type):
+        return self._request(*self._state_request(addr, get_type, state_type))
 
     def get_light(self, host, port=LIFX_PORT, target_addr=None):
         if target_addr is None:
@@ -393,14 +1443,13 @@ class LifxBackend(Backend):
             addr = host, port, target_addr
             if not self._ping(addr):
                 raise ValueError('light not found')
-        return LifxLight(self, addr)
+        return self._register_light(addr)
 
     def _get_state_packet(self, addr, get_type, state_type):
         return self._get_state_response(addr, get_type, state_type)[1]
 
     def _get_device_info(self, addr, get, state):
-        info = self._get_state_packet(addr, get, state)
-        return info['signal'], info['tx'], info['rx']
+        return self._parse_device_info(self._get_state_packet(addr, get, state))
 
     def _get_host_info(self, addr):
         return self._get_device_info(addr, MessageType.GetHostInfo, MessageType.StateHostInfo)
@@ -409,12 +1458,7 @@ class LifxBackend(Backend):
         return self._get_device_info(addr, MessageType.GetWifiInfo, MessageType.StateWifiInfo)
 
     def _get_firmware(self, addr, get, state):
-        firmware = self._get_state_packet(addr, get, state)
-        version = firmware['version']
-        build = self._convert_datetime(firmware['build'])
-        major = version >> 16
-        minor = version & 0xff
-        return build, major, minor
+        return self._parse_firmware(self._get_state_packet(addr, get, state))
 
     def _get_host_firmware(self, addr):
         return self._get_firmware(addr, MessageType.GetHostFirmware, MessageType.StateHostFirmware)
@@ -428,152 +1472,442 @@ class LifxBackend(Backend):
 
     def _get_version(self, addr):
         version = self._get_state_packet(addr, MessageType.GetVersion, MessageType.StateVersion)
-        return version['vendor'], version['product'], version['version']
+        return self._parse_version(version)
 
     def _get_info(self, addr):
         info = self._get_state_packet(addr, MessageType.GetInfo, MessageType.StateInfo)
-        time = self._convert_datetime(info['time'])
-        uptime = self._convert_timedelta(info['uptime'])
-        downtime = self._convert_timedelta(info['downtime'])
-        return time, uptime, downtime
+        return self._parse_info(info)
 
     def _get_location(self, addr):
         loc = self._get_state_packet(addr, MessageType.GetLocation, MessageType.StateLocation)
-        label = self._convert_string(loc['label'])
-        updated_at = self._convert_datetime(loc['updated_at'])
-        return loc['location'], label, updated_at
+        return self._parse_location(loc)
 
     def _get_group(self, addr):
         group = self._get_state_packet(addr, MessageType.GetGroup, MessageType.StateGroup)
-        label = self._convert_string(group['label'])
-        updated_at = self._convert_datetime(group['updated_at'])
-        return group['group'], label, updated_at
+        return self._parse_group(group)
 
     def _get_light_state(self, addr):
         state = self._get_state_packet(addr, MessageType.LightGet, MessageType.LightState)
         return state
 
-    @with_socket
-    def _ping(self, sock, addr):
-        host, port, target_addr = addr
-        payload = bytes([random.getrandbits(8) for _ in range(EchoRequest.total_bytes)])
-
-        for i in range(self.tries):
-            packet = EchoRequest(payload=payload)
-            sock.sendto(self._make_packet(self.source_id, target_addr, i, packet), (host, port))
-            while True:
-                try:
-                    data, from_addr = sock.recvfrom(4096)
-                except socket.timeout:
-                    break
-                if from_addr != (host, port):
-                    continue
-                response = self._parse_response(data, MessageType.EchoResponse)
-                if response is not None and response[1]['payload'] == payload:
-                    return True
-
-        return False
-
-    @with_socket
-    def _get_set_packet(self, sock, addr, set_packet, state_type=None):
-        host, port, target_addr = addr
-        if state_type is None:
-            res = False
-        else:
-            res = True
-
-        ack = False
-        response = None
-
-        for i in range(self.tries):
-            packet = self._make_packet(self.source_id, target_addr, i, set_packet, True, res)
-            sock.sendto(packet, (host, port))
-            while True:
-                try:
-                    data, from_addr = sock.recvfrom(4096)
-                except socket.timeout:
-                    break
-                if from_addr != (host, port):
-                    continue
-                header = Header.from_bytes(data)
-                if header.payload_type is MessageType.Acknowledgement:
-                    ack = True
-                elif res and header.payload_type is state_type:
-                    response_data = data[Header.total_bytes:]
-                    response = state_type.get_bitfield().from_bytes(response_data)
-
-                if ack and (not res or response is not None):
-                    return response
+    def _ping(self, addr):
+        payload = self._make_echo_payload()
+        packet = EchoRequest(payload=payload)
+        try:
+            return self._request(addr, packet, self._echo_handler(payload))
+        except LichtTimeoutError:
+            return False
 
-        return LichtTimeoutError()
+    def _get_set_packet(self, addr, set_packet, state_type=None, ack_mode=None):
+        response = self._request(*self._set_request(addr, set_packet, state_type, ack_mode))
+        if response is not None:
+            return response[0]
 
-    def _set_power(self, addr, level):
+    def _set_power(self, addr, level, ack_mode=None):
         packet = SetPower(level)
-        return self._get_set_packet(addr, packet, MessageType.StatePower)
+        return self._get_set_packet(addr, packet, MessageType.StatePower, ack_mode)
 
-    def _set_color(self, addr, h, s, b, k, ms):
+    def _set_color(self, addr, h, s, b, k, ms, ack_mode=None):
         packet = LightSetColor(HSBK(h, s, b, k), ms)
-        return self._get_set_packet(addr, packet, MessageType.LightState)
+        return self._get_set_packet(addr, packet, MessageType.LightState, ack_mode)
 
     def get_label(self, light):
-        label = self._get_state_packet(light.addr, MessageType.GetLabel, MessageType.StateLabel)
-        return self._convert_string(label['label'])
+        label = self._get_cached_state(light.addr, 'label')
+        if label is None:
+            label = self._parse_label(
+                self._get_state_packet(light.addr, MessageType.GetLabel, MessageType.StateLabel)
+            )
+        return label
 
     def get_power(self, light):
-        power = self._get_power(light.addr)
-        if power == 0:
-            return LightPower.OFF
-        else:
-            return LightPower.ON
+        power = self._get_cached_state(light.addr, 'power')
+        if power is None:
+            power = self._parse_power(self._get_power(light.addr))
+        return power
 
-    def set_power(self, light, power):
-        if power is LightPower.OFF:
-            level = 0
-        else:
-            level = 65535
-        power = self._set_power(light.addr, level)
-        if power['level'] == 0:
-            return LightPower.OFF
-        else:
-            return LightPower.ON
+    def set_power(self, light, power, ack_mode=None):
+        level = self._power_to_level(power)
+        state = self._set_power(light.addr, level, ack_mode)
+        return self._set_result(ack_mode, state, self._parse_power(level), self._power_from_state)
 
     def get_color(self, light):
-        hsbk = self._get_light_state(light.addr)['color']
-        return self._to_color(hsbk)
-
-    def fade_color(self, light, color, ms):
-        if isinstance(color, LightColor):
-            h, s, b = color
-            h = int(h * 65535 / 360)
-            s = int(s * 65535)
-            b = int(b * 65535)
-            state = self._set_color(light.addr, h, s, b, 3500, ms)
+        color = self._get_cached_state(light.addr, 'color')
+        if color is None:
+            color = self._to_color(self._get_light_state(light.addr)['color'])
+        return color
+
+    def fade_color(self, light, color, ms, ack_mode=None):
+        h, s, b, k = self._color_to_hsbk(color)
+        state = self._set_color(light.addr, h, s, b, k, ms, ack_mode)
+        return self._set_result(ack_mode, state, color, self._color_from_state)
+
+    def get_state(self, light):
+        status = self._get_cached_status(light.addr)
+        if status is None:
+            status = self._status_from_state(self._get_light_state(light.addr))
+        return status
+
+    def get_zones(self, light):
+        # the packed HSBK values of all zones of a strip as an array('H')
+        return self._request(light.addr, MessageType.GetExtendedColorZones, self._zones_handler())
+
+    def set_zones(self, light, hsbk, ms=0, index=0, ack_mode=None):
+        # sets the zones starting at zone index with one packet per MAX_ZONES zones, with
+        # AckMode.STATE the packed HSBK values of all zones of the strip are returned
+        requests, hsbk = self._zones_requests(light.addr, hsbk, ms, index, ack_mode)
+        for request in requests:
+            response = self._request(*request)
+        return self._set_result(ack_mode, response, hsbk, self._zones_from_state)
+
+    def get_tile(self, light, tile_index=0, x=0, y=0, width=8):
+        packet = Get64(tile_index, 1, x, y, width)
+        state = self._request(
+            light.addr, packet, self._state_handler(MessageType.State64), False, False
+        )
+        return state[1]['colors']
+
+    def set_tile(self, light, hsbk, tile_index=0, ms=0, x=0, y=0, width=8, ack_mode=None):
+        # sets the 64 pixels of one tile of a chain with a single packet
+        packet = self._tile_packet(hsbk, tile_index, ms, x, y, width)
+        ack_mode = self._tile_ack_mode(ack_mode)
+        self._get_set_packet(light.addr, packet, None, ack_mode)
+        return self._set_result(ack_mode, None, packet['colors'], None)
+
+    def get_power_many(self, lights, as_completed=False):
+        return self._run_requests_many(
+            lights, as_completed,
+            lambda addr: self._state_request(addr, MessageType.GetPower, MessageType.StatePower),
+            lambda response: self._parse_power(response[1]['level']),
+            lambda addr: self._get_cached_state(addr, 'power'),
+        )
+
+    def set_power_many(self, lights, power, as_completed=False, ack_mode=None):
+        level = self._power_to_level(power)
+        packet = SetPower(level)
+        return self._run_requests_many(
+            lights, as_completed,
+            lambda addr: self._set_request(addr, packet, MessageType.StatePower, ack_mode),
+            lambda response: self._set_result(
+                ack_mode, response and response[0], self._parse_power(level),
+                self._power_from_state,
+            ),
+        )
+
+    def get_color_many(self, lights, as_completed=False):
+        return self._run_requests_many(
+            lights, as_completed,
+            lambda addr: self._state_request(addr, MessageType.LightGet, MessageType.LightState),
+            lambda response: self._to_color(response[1]['color']),
+            lambda addr: self._get_cached_state(addr, 'color'),
+        )
+
+    def fade_color_many(self, lights, color, ms, as_completed=False, ack_mode=None):
+        packet = LightSetColor(HSBK(*self._color_to_hsbk(color)), ms)
+        return self._run_requests_many(
+            lights, as_completed,
+            lambda addr: self._set_request(addr, packet, MessageType.LightState, ack_mode),
+            lambda response: self._set_result(
+                ack_mode, response and response[0], color, self._color_from_state
+            ),
+        )
+
+
+class _PolledLight(object):
+    __slots__ = ('light', 'status', 'failures', 'due', 'removed')
+
+    def __init__(self, light, due):
+        self.light = light
+        self.status = None
+        self.failures = 0
+        self.due = due
+        self.removed = False
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+
+class LightPoller(object):
+    # polls the state of many lights with a LightGet every interval seconds plus a random
+    # delay of up to jitter seconds and reports every change of power, color or label as
+    # a LightChange, either to callback or to whoever iterates over the poller, the first
+    # state of a light is reported with old set to None, lights that don't respond are
+    # polled less often, up to max_backoff seconds apart
+    def __init__(self, backend, lights, interval=1, jitter=0.1, callback=None, max_backoff=60):
+        self.backend = backend
+        self.interval = interval
+        self.jitter = jitter
+        self.callback = callback
+        self.max_backoff = max_backoff
+        self._entries = {}
+        self._due = []
+        self._condition = threading.Condition()
+        self._changes = queue.Queue()
+        self._stopped = False
+        self._thread = None
+        for light in lights:
+            self.add(light)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __iter__(self):
+        while True:
+            change = self._changes.get()
+            if change is None:
+                return
+            yield change
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='licht-lifx-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def add(self, light):
+        # the first poll of every light is spread over one interval
+        entry = _PolledLight(light, time.monotonic() + random.uniform(0, self.interval))
+        with self._condition:
+            if light not in self._entries:
+                self._entries[light] = entry
+                heapq.heappush(self._due, entry)
+                self._condition.notify()
+
+    def remove(self, light):
+        with self._condition:
+            entry = self._entries.pop(light, None)
+            if entry is not None:
+                entry.removed = True
+
+    def get_status(self, light):
+        # the last polled state of the light or None
+        entry = self._entries.get(light)
+        if entry is not None:
+            return entry.status
+
+    def _emit(self, change):
+        if self.callback is None:
+            self._changes.put(change)
         else:
-            b, k = color
-            b = int(b * 65535)
-            state = self._set_color(light.addr, 0, 0, b, k, ms)
-        return self._to_color(state['color'])
-
-
-# don't need with_socket anymore
-del with_socket
+            try:
+                self.callback(change)
+            except Exception:
+                # an error in the callback must not stop polling the other lights
+                logger.exception('poller callback failed for %r', change)
+
+    def _update(self, entry, status, now):
+        if status is None:
+            entry.failures += 1
+            delay = min(self.interval * 2 ** entry.failures, self.max_backoff)
+        else:
+            entry.failures = 0
+            delay = self.interval
+            old = entry.status
+            entry.status = status
+            for name in LightStatus._fields:
+                old_value = None if old is None else getattr(old, name)
+                new_value = getattr(status, name)
+                if old_value != new_value:
+                    self._emit(LightChange(entry.light, name, old_value, new_value))
+        entry.due = now + delay + random.uniform(0, self.jitter)
+
+    def _poll(self, entries):
+        backend = self.backend
+        requests = [
+            backend._state_request(entry.light.addr, MessageType.LightGet, MessageType.LightState)
+            for entry in entries
+        ]
+        # a poll never takes longer than one interval so lights that don't respond don't
+        # delay the others
+        timeout = min(backend.timeout, self.interval)
+        for index, response, error in backend._run_requests(
+            requests, Priority.BACKGROUND, timeout
+        ):
+            entry = entries[index]
+            status = None
+            if error is None:
+                try:
+                    status = backend._status_from_state(response[1])
+                except Exception:
+                    # a state that can't be converted counts as a failed poll of this light
+                    # and must not stop the poller for all the others
+                    logger.exception('polling the light at %r failed', entry.light.addr)
+            self._update(entry, status, time.monotonic())
+            with self._condition:
+                if not entry.removed:
+                    heapq.heappush(self._due, entry)
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._stopped:
+                        now = time.monotonic()
+                        while self._due and self._due[0].removed:
+                            heapq.heappop(self._due)
+                        if self._due and self._due[0].due <= now:
+                            break
+                        self._condition.wait(self._due[0].due - now if self._due else None)
+                    if self._stopped:
+                        return
+                    entries = []
+                    while self._due and self._due[0].due <= now:
+                        entry = heapq.heappop(self._due)
+                        if not entry.removed:
+                            entries.append(entry)
+                self._poll(entries)
+        except LichtError:
+            # the backend was closed
+            pass
+        finally:
+            self._changes.put(None)
+
+
+class _IndexEntry(object):
+    __slots__ = ('id', 'label', 'updated_at', 'lights')
+
+    def __init__(self, entry_id, label, updated_at):
+        self.id = entry_id
+        self.label = label
+        self.updated_at = updated_at
+        self.lights = set()
+
+
+class LightIndex(object):
+    # maps the ids and labels of groups and locations to their lights, refresh() asks all
+    # lights at once, the label with the newest updated_at wins if members disagree
+    kinds = {
+        'group': (MessageType.GetGroup, MessageType.StateGroup),
+        'location': (MessageType.GetLocation, MessageType.StateLocation),
+    }
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lights = set()
+        self._entries = {kind: {} for kind in self.kinds}
+        self._labels = {kind: {} for kind in self.kinds}
+        # (kind, light) -> (id, updated_at)
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, lights=None):
+        # asks the given lights or all lights of the index for their group and location and
+        # returns the LightResults of the lights that didn't respond
+        if lights is None:
+            with self._lock:
+                lights = list(self._lights)
+        backend = self.backend
+        keys = [(kind, light) for light in lights for kind in self.kinds]
+        requests = [backend._state_request(light.addr, *self.kinds[kind]) for kind, light in keys]
+        failed = {}
+        for index, response, error in backend._run_requests(requests):
+            kind, light = keys[index]
+            if error is None:
+                parse = backend._parse_group if kind == 'group' else backend._parse_location
+                self.update(light, kind, parse(response[1]))
+            else:
+                failed[light] = LightResult(light, None, error)
+        return list(failed.values())
+
+    def update(self, light, kind, info):
+        # info is an (id, label, updated_at) tuple as returned by LifxLight.get_group() or
+        # LifxLight.get_location()
+        entry_id, label, updated_at = info
+        cache = getattr(getattr(type(light), 'get_' + kind, None), 'cache', None)
+        if isinstance(cache, MethodCache):
+            cache.set(light, info)
+
+        with self._lock:
+            self._lights.add(light)
+            member = self._members.get((kind, light))
+            if member == (entry_id, updated_at):
+                return
+            entries = self._entries[kind]
+            if member is not None and member[0] != entry_id:
+                self._remove(kind, light, member[0])
+
+            entry = entries.get(entry_id)
+            if entry is None:
+                entry = entries[entry_id] = _IndexEntry(entry_id, label, updated_at)
+                self._labels[kind].setdefault(label, set()).add(entry_id)
+            elif updated_at > entry.updated_at:
+                entry.updated_at = updated_at
+                if label != entry.label:
+                    self._discard_label(kind, entry)
+                    entry.label = label
+                    self._labels[kind].setdefault(label, set()).add(entry_id)
+            entry.lights.add(light)
+            self._members[kind, light] = entry_id, updated_at
+
+    def _discard_label(self, kind, entry):
+        ids = self._labels[kind][entry.label]
+        ids.discard(entry.id)
+        if not ids:
+            del self._labels[kind][entry.label]
+
+    def _remove(self, kind, light, entry_id):
+        entry = self._entries[kind][entry_id]
+        entry.lights.discard(light)
+        if not entry.lights:
+            del self._entries[kind][entry_id]
+            self._discard_label(kind, entry)
+
+    def remove(self, light):
+        with self._lock:
+            self._lights.discard(light)
+            for kind in self.kinds:
+                member = self._members.pop((kind, light), None)
+                if member is not None:
+                    self._remove(kind, light, member[0])
+
+    def _get_lights(self, kind, key):
+        # key is either the id or the label
+        with self._lock:
+            entry = self._entries[kind].get(key)
+            if entry is not None:
+                return LightGroup(self.backend, entry.lights)
+            ids = self._labels[kind].get(key)
+            if ids is None:
+                raise KeyError(key)
+            lights = set()
+            for entry_id in ids:
+                lights.update(self._entries[kind][entry_id].lights)
+            return LightGroup(self.backend, lights)
+
+    def get_group(self, key):
+        return self._get_lights('group', key)
+
+    def get_location(self, key):
+        return self._get_lights('location', key)
+
+    def get_groups(self):
+        # maps the ids of all groups to their labels
+        with self._lock:
+            return {entry.id: entry.label for entry in self._entries['group'].values()}
+
+    def get_locations(self):
+        with self._lock:
+            return {entry.id: entry.label for entry in self._entries['location'].values()}
 
 
 class LifxLight(Light):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
     def get_host_info(self):
         return self.backend._get_host_info(self.addr)
 
-    @cache_method
+    @cache_method(ttl=3600)
     def get_host_firmware(self):
         return self.backend._get_host_firmware(self.addr)
 
     def get_wifi_info(self):
         return self.backend._get_wifi_info(self.addr)
 
-    @cache_method
+    @cache_method(ttl=3600)
     def get_wifi_firmware(self):
         return self.backend._get_wifi_firmware(self.addr)
 
@@ -584,13 +1918,37 @@ class LifxLight(Light):
     def get_times(self):
         return self.backend._get_info(self.addr)
 
-    @cache_method
+    @cache_method(ttl=300)
     def get_location(self):
         return self.backend._get_location(self.addr)
 
-    @cache_method
+    @cache_method(ttl=300)
     def get_group(self):
         return self.backend._get_group(self.addr)
 
     def ping(self):
         return self.backend._ping(self.addr)
+
+    def poll(self, interval=1, jitter=0.1, callback=None, max_backoff=60):
+        return self.backend.poll_lights([self], interval, jitter, callback, max_backoff)
+
+    def set_power(self, power, ack_mode=None):
+        return self.backend.set_power(self, power, ack_mode)
+
+    def set_color(self, color, ack_mode=None):
+        return self.backend.set_color(self, color, ack_mode)
+
+    def fade_color(self, color, ms, ack_mode=None):
+        return self.backend.fade_color(self, color, ms, ack_mode)
+
+    def get_zones(self):
+        return self.backend.get_zones(self)
+
+    def set_zones(self, hsbk, ms=0, index=0, ack_mode=None):
+        return self.backend.set_zones(self, hsbk, ms, index, ack_mode)
+
+    def get_tile(self, tile_index=0, x=0, y=0, width=8):
+        return self.backend.get_tile(self, tile_index, x, y, width)
+
+    def set_tile(self, hsbk, tile_index=0, ms=0, x=0, y=0, width=8, ack_mode=None):
+        return self.backend.set_tile(self, hsbk, tile_index, ms, x, y, width, ack_mode)
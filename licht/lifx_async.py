@@ -0,0 +1,370 @@
+import asyncio
+import functools
+
+from .base import LightResult
+from .exceptions import LichtError, LichtTimeoutError
+from .lifx import (
+    HSBK, LIFX_PORT, AckMode, BaseLifxBackend, EchoRequest, Get64, LifxLight, LightSetColor,
+    MessageType, SetPower, _Discovery,
+)
+from .utils import MethodCache
+
+
+def cache_coroutine(meth=None, ttl=None, maxsize=16384):
+    # like cache_method, concurrent misses await the same task
+    if meth is None:
+        return functools.partial(cache_coroutine, ttl=ttl, maxsize=maxsize)
+    cache = MethodCache(ttl, maxsize)
+
+    def finish(instance, task):
+        del cache.flights[instance]
+        if not task.cancelled() and task.exception() is None:
+            cache.set(instance, task.result())
+
+    @functools.wraps(meth)
+    async def func(self):
+        entry = cache.get(self)
+        if entry is not None:
+            return entry[1]
+        task = cache.flights.get(self)
+        if task is None:
+            task = cache.flights[self] = asyncio.ensure_future(meth(self))
+            task.add_done_callback(functools.partial(finish, self))
+        return await asyncio.shield(task)
+
+    func.cache = cache
+    return func
+
+
+class _LifxProtocol(asyncio.DatagramProtocol):
+    def __init__(self, router):
+        self.router = router
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def datagram_received(self, data, addr):
+        self.router.route(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+class AsyncLifxBackend(BaseLifxBackend):
+    def __init__(
+        self, source_id=b'lcht', timeout=3, tries=3, ack_mode=AckMode.STATE, state_ttl=None
+    ):
+        super().__init__(source_id, timeout, tries, ack_mode, state_ttl)
+        self._protocol = None
+
+    def _make_light(self, addr):
+        return AsyncLifxLight(self, addr)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._protocol is not None:
+            if self._protocol.transport is not None:
+                self._protocol.transport.close()
+            self._protocol = None
+
+    async def _get_protocol(self):
+        if self._protocol is None or self._protocol.transport is None:
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: _LifxProtocol(self._router),
+                local_addr=('0.0.0.0', 0),
+                allow_broadcast=True,
+            )
+            # another coroutine might have created an endpoint in the meantime
+            if self._protocol is None or self._protocol.transport is None:
+                self._protocol = protocol
+            else:
+                transport.close()
+        return self._protocol
+
+    async def _request(self, addr, payload, handle, ack=False, res=False):
+        host, port, target_addr = addr
+        protocol = await self._get_protocol()
+        if handle is None:
+            # fire and forget, no response will arrive
+            packet = self._make_packet(target_addr, 0, payload, ack, res)
+            protocol.transport.sendto(packet, (host, port))
+            return None
+        loop = asyncio.get_running_loop()
+        rtt = self._get_rtt_estimator(addr)
+        final_deadline = loop.time() + self.timeout
+        responses = asyncio.Queue()
+        source, seq = self._router.register(responses.put_nowait)
+        try:
+            packet = self._make_packet(target_addr, seq, payload, ack, res, source)
+            for attempt in range(self.tries):
+                sent = loop.time()
+                if sent >= final_deadline:
+                    break
+                deadline = min(sent + rtt.rto(attempt), final_deadline)
+                protocol.transport.sendto(packet, (host, port))
+                while True:
+                    try:
+                        msg_type, data, from_addr = await asyncio.wait_for(
+                            responses.get(), deadline - loop.time()
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                    result = handle(msg_type, data)
+                    if result is not None:
+                        # Karn's algorithm: replies to retransmitted packets are ambiguous
+                        if attempt == 0:
+                            rtt.add_sample(loop.time() - sent)
+                        return result
+        finally:
+            self._router.unregister(source, seq)
+
+        raise LichtTimeoutError()
+
+    async def _call_many(self, light, method, args):
+        try:
+            value = await method(light, *args)
+        except LichtError as e:
+            return LightResult(light, None, e)
+        else:
+            return LightResult(light, value, None)
+
+    async def _iter_completed(self, calls):
+        for call in asyncio.as_completed(calls):
+            yield await call
+
+    def _run_many(self, lights, as_completed, method, *args):
+        # returns a coroutine with the list of results, or an async iterator over the
+        # results in the order the lights finish if as_completed is set, the calls run as
+        # tasks right away in both cases
+        calls = [asyncio.ensure_future(self._call_many(light, method, args)) for light in lights]
+        if as_completed:
+            return self._iter_completed(calls)
+        return asyncio.gather(*calls)
+
+    def set_power_many(self, lights, power, as_completed=False, ack_mode=None):
+        return self._run_many(lights, as_completed, self.set_power, power, ack_mode)
+
+    def fade_color_many(self, lights, color, ms, as_completed=False, ack_mode=None):
+        return self._run_many(lights, as_completed, self.fade_color, color, ms, ack_mode)
+
+    async def discover_lights(self, timeout=None, count=None, quiet=None):
+        protocol = await self._get_protocol()
+        responses = asyncio.Queue()
+        source, seq = self._router.register(responses.put_nowait)
+        try:
+            packet = self._make_packet(None, seq, MessageType.GetService, source=source)
+            discovery = _Discovery(self, timeout, count, quiet)
+
+            while True:
+                broadcast, wait = discovery.poll()
+                if wait is None:
+                    break
+                if broadcast:
+                    protocol.transport.sendto(packet, self.broadcast_addr)
+                try:
+                    msg_type, data, (host, port) = await asyncio.wait_for(responses.get(), wait)
+                except asyncio.TimeoutError:
+                    continue
+                addr = discovery.add(data, host)
+                if addr is not None:
+                    yield self._register_light(addr)
+        finally:
+            self._router.unregister(source, seq)
+
+    async def _get_state_response(self, addr, get_type, state_type):
+        return await self._request(*self._state_request(addr, get_type, state_type))
+
+    async def get_light(self, host, port=LIFX_PORT, target_addr=None):
+        if target_addr is None:
+            header, service = await self._get_state_response(
+                (host, port, None), MessageType.GetService, MessageType.StateService
+            )
+            addr = host, service['port'], header['frame_address']['target']
+        else:
+            addr = host, port, target_addr
+            if not await self._ping(addr):
+                raise ValueError('light not found')
+        return self._register_light(addr)
+
+    async def _get_state_packet(self, addr, get_type, state_type):
+        return (await self._get_state_response(addr, get_type, state_type))[1]
+
+    async def _get_device_info(self, addr, get, state):
+        return self._parse_device_info(await self._get_state_packet(addr, get, state))
+
+    async def _get_host_info(self, addr):
+        return await self._get_device_info(
+            addr, MessageType.GetHostInfo, MessageType.StateHostInfo
+        )
+
+    async def _get_wifi_info(self, addr):
+        return await self._get_device_info(
+            addr, MessageType.GetWifiInfo, MessageType.StateWifiInfo
+        )
+
+    async def _get_firmware(self, addr, get, state):
+        return self._parse_firmware(await self._get_state_packet(addr, get, state))
+
+    async def _get_host_firmware(self, addr):
+        return await self._get_firmware(
+            addr, MessageType.GetHostFirmware, MessageType.StateHostFirmware
+        )
+
+    async def _get_wifi_firmware(self, addr):
+        return await self._get_firmware(
+            addr, MessageType.GetWifiFirmware, MessageType.StateWifiFirmware
+        )
+
+    async def _get_power(self, addr):
+        power = await self._get_state_packet(addr, MessageType.GetPower, MessageType.StatePower)
+        return power['level']
+
+    async def _get_version(self, addr):
+        version = await self._get_state_packet(
+            addr, MessageType.GetVersion, MessageType.StateVersion
+        )
+        return self._parse_version(version)
+
+    async def _get_info(self, addr):
+        info = await self._get_state_packet(addr, MessageType.GetInfo, MessageType.StateInfo)
+        return self._parse_info(info)
+
+    async def _get_location(self, addr):
+        loc = await self._get_state_packet(
+            addr, MessageType.GetLocation, MessageType.StateLocation
+        )
+        return self._parse_location(loc)
+
+    async def _get_group(self, addr):
+        group = await self._get_state_packet(addr, MessageType.GetGroup, MessageType.StateGroup)
+        return self._parse_group(group)
+
+    async def _get_light_state(self, addr):
+        return await self._get_state_packet(addr, MessageType.LightGet, MessageType.LightState)
+
+    async def _ping(self, addr):
+        payload = self._make_echo_payload()
+        packet = EchoRequest(payload=payload)
+        try:
+            return await self._request(addr, packet, self._echo_handler(payload))
+        except LichtTimeoutError:
+            return False
+
+    async def _get_set_packet(self, addr, set_packet, state_type=None, ack_mode=None):
+        response = await self._request(
+            *self._set_request(addr, set_packet, state_type, ack_mode)
+        )
+        if response is not None:
+            return response[0]
+
+    async def _set_power(self, addr, level, ack_mode=None):
+        packet = SetPower(level)
+        return await self._get_set_packet(addr, packet, MessageType.StatePower, ack_mode)
+
+    async def _set_color(self, addr, h, s, b, k, ms, ack_mode=None):
+        packet = LightSetColor(HSBK(h, s, b, k), ms)
+        return await self._get_set_packet(addr, packet, MessageType.LightState, ack_mode)
+
+    async def get_label(self, light):
+        label = self._get_cached_state(light.addr, 'label')
+        if label is None:
+            label = self._parse_label(await self._get_state_packet(
+                light.addr, MessageType.GetLabel, MessageType.StateLabel
+            ))
+        return label
+
+    async def get_power(self, light):
+        power = self._get_cached_state(light.addr, 'power')
+        if power is None:
+            power = self._parse_power(await self._get_power(light.addr))
+        return power
+
+    async def set_power(self, light, power, ack_mode=None):
+        level = self._power_to_level(power)
+        state = await self._set_power(light.addr, level, ack_mode)
+        return self._set_result(ack_mode, state, self._parse_power(level), self._power_from_state)
+
+    async def get_color(self, light):
+        color = self._get_cached_state(light.addr, 'color')
+        if color is None:
+            color = self._to_color((await self._get_light_state(light.addr))['color'])
+        return color
+
+    async def get_state(self, light):
+        status = self._get_cached_status(light.addr)
+        if status is None:
+            status = self._status_from_state(await self._get_light_state(light.addr))
+        return status
+
+    async def fade_color(self, light, color, ms, ack_mode=None):
+        h, s, b, k = self._color_to_hsbk(color)
+        state = await self._set_color(light.addr, h, s, b, k, ms, ack_mode)
+        return self._set_result(ack_mode, state, color, self._color_from_state)
+
+    async def get_zones(self, light):
+        return await self._request(
+            light.addr, MessageType.GetExtendedColorZones, self._zones_handler()
+        )
+
+    async def set_zones(self, light, hsbk, ms=0, index=0, ack_mode=None):
+        requests, hsbk = self._zones_requests(light.addr, hsbk, ms, index, ack_mode)
+        for request in requests:
+            response = await self._request(*request)
+        return self._set_result(ack_mode, response, hsbk, self._zones_from_state)
+
+    async def get_tile(self, light, tile_index=0, x=0, y=0, width=8):
+        packet = Get64(tile_index, 1, x, y, width)
+        state = await self._request(
+            light.addr, packet, self._state_handler(MessageType.State64), False, False
+        )
+        return state[1]['colors']
+
+    async def set_tile(self, light, hsbk, tile_index=0, ms=0, x=0, y=0, width=8, ack_mode=None):
+        packet = self._tile_packet(hsbk, tile_index, ms, x, y, width)
+        ack_mode = self._tile_ack_mode(ack_mode)
+        await self._get_set_packet(light.addr, packet, None, ack_mode)
+        return self._set_result(ack_mode, None, packet['colors'], None)
+
+
+class AsyncLifxLight(LifxLight):
+    # all other methods of LifxLight return the backend's coroutines as they are
+    def __str__(self):
+        return 'LIFX light at {}:{}'.format(*self.addr[:2])
+
+    def poll(self, interval=1, jitter=0.1, callback=None, max_backoff=60):
+        # the poller sends blocking requests from its own thread
+        raise NotImplementedError('the asyncio backend does not support polling')
+
+    @cache_coroutine(ttl=300)
+    async def get_label(self):
+        return await self.backend.get_label(self)
+
+    @cache_coroutine(ttl=3600)
+    async def get_host_firmware(self):
+        return await self.backend._get_host_firmware(self.addr)
+
+    @cache_coroutine(ttl=3600)
+    async def get_wifi_firmware(self):
+        return await self.backend._get_wifi_firmware(self.addr)
+
+    @cache_coroutine
+    async def get_version(self):
+        return await self.backend._get_version(self.addr)
+
+    @cache_coroutine(ttl=300)
+    async def get_location(self):
+        return await self.backend._get_location(self.addr)
+
+    @cache_coroutine(ttl=300)
+    async def get_group(self):
+        return await self.backend._get_group(self.addr)
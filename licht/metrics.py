@@ -0,0 +1,138 @@
+import bisect
+import threading
+from collections import namedtuple
+from enum import IntEnum
+
+
+class RequestOutcome(IntEnum):
+    # SENT is a request that doesn't wait for a response
+    OK = 0
+    TIMEOUT = 1
+    ERROR = 2
+    SENT = 3
+
+
+# one finished request, attempts is 0 if an identical newer request was sent in its place,
+# rtt is the time from the last attempt to the response and duration the whole request in
+# seconds, encode_time and decode_time are only measured if spans are enabled
+RequestEvent = namedtuple('RequestEvent', [
+    'msg_type', 'target', 'attempts', 'rtt', 'duration', 'bytes_sent', 'bytes_received',
+    'outcome', 'encode_time', 'decode_time',
+])
+
+
+class Histogram(object):
+    # counts values in buckets that double in size, from 0.1 ms up to about 13 seconds
+    bounds = tuple(0.0001 * 2 ** i for i in range(18))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        # the upper bound of the bucket with the p-th percentile, or None if the histogram
+        # is empty or the value is above the highest bound
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': dict(zip(self.bounds + (None,), self.counts)),
+        }
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.outcomes = {outcome: 0 for outcome in RequestOutcome}
+        self.attempts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rtt = Histogram()
+        self.duration = Histogram()
+        self.encode = Histogram()
+        self.decode = Histogram()
+
+    def add(self, event):
+        self.requests += 1
+        self.outcomes[event.outcome] += 1
+        self.attempts += event.attempts
+        self.retries += max(0, event.attempts - 1)
+        self.bytes_sent += event.bytes_sent
+        self.bytes_received += event.bytes_received
+        for histogram, value in (
+            (self.rtt, event.rtt), (self.duration, event.duration),
+            (self.encode, event.encode_time), (self.decode, event.decode_time),
+        ):
+            if value is not None:
+                histogram.add(value)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'outcomes': {outcome.name.lower(): count for outcome, count in self.outcomes.items()},
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'rtt': self.rtt.as_dict(),
+            'duration': self.duration.as_dict(),
+            'encode': self.encode.as_dict(),
+            'decode': self.decode.as_dict(),
+        }
+
+
+class Metrics(object):
+    # aggregates RequestEvents per message type and per light target
+    def __init__(self):
+        self.total = RequestStats()
+        self.by_type = {}
+        self.by_light = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.total.add(event)
+            for stats, key in ((self.by_type, event.msg_type), (self.by_light, event.target)):
+                entry = stats.get(key)
+                if entry is None:
+                    entry = stats[key] = RequestStats()
+                entry.add(event)
+
+    def reset(self):
+        with self._lock:
+            self.total = RequestStats()
+            self.by_type = {}
+            self.by_light = {}
+
+    def as_dict(self):
+        # plain values that can be dumped as JSON, lights are keyed by their hex target
+        with self._lock:
+            return {
+                'total': self.total.as_dict(),
+                'by_type': {
+                    msg_type.name: stats.as_dict() for msg_type, stats in self.by_type.items()
+                },
+                'by_light': {
+                    (target.hex() if target is not None else 'broadcast'): stats.as_dict()
+                    for target, stats in self.by_light.items()
+                },
+            }
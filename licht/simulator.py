@@ -0,0 +1,337 @@
+import hashlib
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+from array import array
+
+from .lifx import (
+    HSBK, MAX_ZONES, TILE_PIXELS, EchoRequest, EchoResponse, Frame, FrameAddress, Get64, Header,
+    LightSetColor, LightState, MessageType, ProtocolHeader, Set64, SetExtendedColorZones,
+    SetPower, State64, StateExtendedColorZones, StateGroup, StateHostFirmware, StateHostInfo,
+    StateInfo, StateLabel, StateLocation, StatePower, StateService, StateVersion,
+    StateWifiFirmware, StateWifiInfo,
+)
+
+
+class SimulatedLight(object):
+    # the state of one virtual device, changed by the packets it receives
+    __slots__ = (
+        'target', 'label', 'power', 'color', 'group', 'location', 'zones', 'tiles', 'tokens',
+        'updated', 'received',
+    )
+
+    def __init__(self, target, label, group, location, zones, tiles):
+        self.target = target
+        self.label = label
+        self.power = 0
+        self.color = HSBK(0, 0, 65535, 3500)
+        # (id, label, updated_at) like StateGroup and StateLocation
+        self.group = group
+        self.location = location
+        # packed HSBK values of all zones of a strip and of all pixels of every tile
+        self.zones = array('H', [0, 0, 65535, 3500] * zones)
+        self.tiles = [array('H', [0, 0, 65535, 3500] * TILE_PIXELS) for _ in range(tiles)]
+        self.tokens = None
+        self.updated = None
+        self.received = 0
+
+
+class LifxSimulator(object):
+    # serves any number of virtual LIFX devices from one UDP socket, every device has its
+    # own target address, requests to the broadcast target are answered by all of them,
+    # responses are delayed by latency plus a random jitter in seconds, every packet in
+    # either direction is lost with the probability loss and every device drops the
+    # packets that exceed rate per second after a burst
+    broadcast_spread = 0.2
+
+    def __init__(
+        self, count=0, host='127.0.0.1', port=0, latency=0, jitter=0, loss=0, rate=None,
+        burst=5, seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rate = rate
+        self.burst = burst
+        self.devices = {}
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._started = time.time()
+        self._due = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+        except OSError:
+            pass
+        self.sock.bind((host, port))
+        self.addr = self.sock.getsockname()
+        for _ in range(count):
+            self.add_device()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _make_group(self, label):
+        # the id of a group or location is derived from its label
+        updated_at = int(self._started) * 10**9
+        return hashlib.md5(label.encode('utf-8')).digest(), label, updated_at
+
+    def add_device(self, label=None, group='Simulated', location='Simulated', zones=0, tiles=0):
+        index = len(self.devices)
+        target = b'\xd0\x73\xd5' + index.to_bytes(3, 'big') + b'\x00\x00'
+        if label is None:
+            label = 'Light {}'.format(index)
+        device = SimulatedLight(
+            target, label, self._make_group(group), self._make_group(location), zones, tiles,
+        )
+        self.devices[target] = device
+        return device
+
+    def get_lights(self, backend):
+        # the lights of all devices, without discovering them first
+        host, port = self.addr
+        return [backend._register_light((host, port, target)) for target in self.devices]
+
+    def start(self):
+        for target, name in (
+            (self._receive, 'licht-simulator-receiver'), (self._send, 'licht-simulator-sender')
+        ):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._threads:
+            # wake up the receiver thread, it closes the socket once it notices
+            try:
+                self.sock.sendto(b'', self.addr)
+            except OSError:
+                self.sock.close()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        else:
+            self.sock.close()
+
+    def _lost(self):
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def _limited(self, device, now):
+        # token bucket per device like the send scheduler of LifxBackend
+        if self.rate is None:
+            return False
+        if device.tokens is None:
+            device.tokens = self.burst
+        else:
+            device.tokens = min(self.burst, device.tokens + (now - device.updated) * self.rate)
+        device.updated = now
+        if device.tokens < 1:
+            self.dropped += 1
+            return True
+        device.tokens -= 1
+        return False
+
+    def _receive(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except OSError:
+                if self.sock.fileno() == -1:
+                    return
+                continue
+            if self._stopped:
+                self.sock.close()
+                return
+            self.received += 1
+            if self._lost():
+                continue
+            try:
+                header = Header.from_bytes(data)
+            except ValueError:
+                continue
+            target = header['frame_address']['target']
+            jitter = self.jitter
+            if header['frame']['tagged'] or target == bytes(8):
+                devices = list(self.devices.values())
+                # the answers to a broadcast are spread out like those of real devices so
+                # they don't overflow the receive buffer of the client
+                jitter = max(jitter, self.broadcast_spread)
+            else:
+                device = self.devices.get(target)
+                devices = [] if device is None else [device]
+
+            now = time.monotonic()
+            packets = []
+            for device in devices:
+                if self._limited(device, now):
+                    continue
+                device.received += 1
+                try:
+                    packets.extend(self._handle(device, header, data))
+                except ValueError:
+                    # a payload that is too short, every device drops the packet
+                    self.dropped += 1
+            if packets:
+                self._respond(packets, addr, now, jitter)
+
+    def _respond(self, packets, addr, now, jitter):
+        if not self.latency and not jitter:
+            for packet in packets:
+                self._sendto(packet, addr)
+            return
+        with self._condition:
+            for packet in packets:
+                due = now + self.latency + self._random.uniform(0, jitter)
+                heapq.heappush(self._due, (due, next(self._counter), packet, addr))
+            self._condition.notify()
+
+    def _sendto(self, packet, addr):
+        if self._lost():
+            return
+        try:
+            self.sock.sendto(packet, addr)
+        except OSError:
+            return
+        self.sent += 1
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._condition.wait(self._due[0][0] - now if self._due else None)
+                if self._stopped:
+                    return
+                ready = []
+                while self._due and self._due[0][0] <= now:
+                    ready.append(heapq.heappop(self._due))
+            for due, count, packet, addr in ready:
+                self._sendto(packet, addr)
+
+    @staticmethod
+    def _packet(device, header, payload):
+        if isinstance(payload, MessageType):
+            msg_type, body = payload, b''
+        else:
+            msg_type, body = payload.message_type, payload.to_bytes()
+        return Header(
+            Frame(Header.total_bytes + len(body), 0, 0, 1, 1024, header['frame']['source']),
+            FrameAddress(device.target, 0, 0, header['frame_address']['sequence']),
+            ProtocolHeader(int(msg_type)),
+        ).to_bytes() + body
+
+    def _state(self, device, msg_type, data):
+        # returns the state packet for a get or set message or None for unknown messages
+        offset = Header.total_bytes
+        if msg_type == MessageType.GetService:
+            return StateService(1, self.addr[1])
+        elif msg_type == MessageType.GetHostInfo:
+            return StateHostInfo(1e-5, 0, 0)
+        elif msg_type == MessageType.GetWifiInfo:
+            return StateWifiInfo(1e-5, 0, 0)
+        elif msg_type == MessageType.GetHostFirmware:
+            return StateHostFirmware(int(self._started) * 10**9, (2 << 16) | 80)
+        elif msg_type == MessageType.GetWifiFirmware:
+            return StateWifiFirmware(int(self._started) * 10**9, (2 << 16) | 80)
+        elif msg_type == MessageType.GetVersion:
+            return StateVersion(1, 32 if device.zones else 55 if device.tiles else 22, 0)
+        elif msg_type == MessageType.GetInfo:
+            now = time.time()
+            return StateInfo(int(now * 10**9), int((now - self._started) * 10**9), 0)
+        elif msg_type == MessageType.GetLocation:
+            location, label, updated_at = device.location
+            return StateLocation(location, label.encode('utf-8'), updated_at)
+        elif msg_type == MessageType.GetGroup:
+            group, label, updated_at = device.group
+            return StateGroup(group, label.encode('utf-8'), updated_at)
+        elif msg_type == MessageType.EchoRequest:
+            return EchoResponse(EchoRequest.from_bytes(data, offset)['payload'])
+        elif msg_type in (MessageType.GetLabel, MessageType.SetLabel):
+            if msg_type == MessageType.SetLabel:
+                label = StateLabel.from_bytes(data, offset)['label']
+                device.label = label.rstrip(b'\x00').decode('utf-8')
+            return StateLabel(device.label.encode('utf-8'))
+        elif msg_type in (MessageType.GetPower, MessageType.SetPower):
+            if msg_type == MessageType.SetPower:
+                device.power = SetPower.from_bytes(data, offset)['level']
+            return StatePower(device.power)
+        elif msg_type in (MessageType.LightGet, MessageType.LightSetColor):
+            if msg_type == MessageType.LightSetColor:
+                device.color = LightSetColor.from_bytes(data, offset)['color']
+            return LightState(device.color, device.power, device.label.encode('utf-8'))
+        elif device.zones and msg_type in (
+            MessageType.GetExtendedColorZones, MessageType.SetExtendedColorZones
+        ):
+            if msg_type == MessageType.SetExtendedColorZones:
+                packet = SetExtendedColorZones.from_bytes(data, offset)
+                start = 4 * packet['index']
+                colors = packet['colors'][:len(device.zones) - start]
+                device.zones[start:start + len(colors)] = colors
+            # both are answered with the states of all zones
+            return [
+                self._zones_state(device, index)
+                for index in range(0, len(device.zones) // 4, MAX_ZONES)
+            ]
+        elif device.tiles and msg_type in (MessageType.Get64, MessageType.Set64):
+            if msg_type == MessageType.Set64:
+                packet = Set64.from_bytes(data, offset)
+            else:
+                packet = Get64.from_bytes(data, offset)
+            tile_index = packet['tile_index']
+            if tile_index >= len(device.tiles):
+                return None
+            if msg_type == MessageType.Set64:
+                device.tiles[tile_index] = array('H', packet['colors'])
+                # Set64 is never answered with a state
+                return []
+            return State64(tile_index, 0, 0, 8, device.tiles[tile_index])
+
+    @staticmethod
+    def _zones_state(device, index):
+        count = len(device.zones) // 4
+        colors = device.zones[4 * index:4 * (index + MAX_ZONES)]
+        return StateExtendedColorZones(count, index, len(colors) // 4, colors)
+
+    def _handle(self, device, header, data):
+        msg_type = header.payload_type
+        frame_address = header['frame_address']
+        packets = []
+        if frame_address['ack_required']:
+            packets.append(self._packet(device, header, MessageType.Acknowledgement))
+        if msg_type is None:
+            return packets
+        states = self._state(device, msg_type, data)
+        if states is None:
+            return packets
+        if not isinstance(states, list):
+            states = [states]
+        # set messages are only answered with a state if it was asked for
+        if msg_type.name.startswith('Get') or msg_type in (
+            MessageType.LightGet, MessageType.EchoRequest
+        ) or frame_address['res_required']:
+            packets.extend(self._packet(device, header, state) for state in states)
+        return packets
@@ -1,8 +1,12 @@
 import functools
 import struct
-from collections import namedtuple
+import sys
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict, namedtuple
 from enum import Enum
-from itertools import islice
 
 
 RESERVED = object()
@@ -81,42 +85,319 @@ def _issubclass(sub, parent):
     return isinstance(sub, type) and issubclass(sub, parent)
 
 
-class Field(namedtuple('FieldBase', ('name', 'bits', 'type'))):
-    def __new__(cls, name, bits=0, type=FieldType.bytes):
+class Field(namedtuple('FieldBase', ('name', 'bits', 'type', 'count', 'length'))):
+    # a field with a count repeats bits count times, bits is then the size of all elements
+    # together, length is the name of an earlier field with the number of elements that are
+    # actually used, the field always takes up the space of count elements
+    def __new__(cls, name, bits=0, type=FieldType.bytes, count=None, length=None):
         if _issubclass(type, Bitfield):
             bits = type.total_bytes * 8
         elif not isinstance(type, FieldType):
             raise TypeError('type must be FieldType or Bitfield')
         if bits <= 0:
             raise ValueError('bits must be greater than 0')
-        return super().__new__(cls, name, bits, type)
+        if count is not None:
+            if count <= 0:
+                raise ValueError('count must be greater than 0')
+            if bits % 8 != 0:
+                raise ValueError('elements of repeated fields must be whole bytes')
+            bits *= count
+        elif length is not None:
+            raise ValueError('length needs a count')
+        return super().__new__(cls, name, bits, type, count, length)
+
+
+_INT_CODES = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+_UINT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_FLOAT_CODES = {4: 'f', 8: 'd'}
+
+# kinds of steps in a compiled plan, every step except _NESTED consumes exactly
+# one value of the unpacked struct
+_RAW = 0
+_CONV = 1
+_BITS = 2
+_NESTED = 3
+_ARRAY = 4
+
+_ARRAY_TYPECODES = {FieldType.uint: 'BHILQ', FieldType.int: 'bhilq', FieldType.float: 'fd'}
+
+
+def _field_codec(field_type, num_bytes):
+    # returns (struct code, decoder, encoder) for a byte aligned field,
+    # decoder and encoder are None if struct already does the conversion
+    if field_type is FieldType.bytes:
+        return '{}s'.format(num_bytes), None, None
+    elif field_type is FieldType.uint and num_bytes in _UINT_CODES:
+        return _UINT_CODES[num_bytes], None, None
+    elif field_type is FieldType.int and num_bytes in _INT_CODES:
+        return _INT_CODES[num_bytes], None, None
+    elif field_type is FieldType.bool and num_bytes == 1:
+        return '?', None, None
+    elif field_type is FieldType.float and num_bytes in _FLOAT_CODES:
+        return _FLOAT_CODES[num_bytes], None, None
+    else:
+        return (
+            '{}s'.format(num_bytes),
+            field_type.from_bytes,
+            lambda value: field_type.to_bytes(value, num_bytes),
+        )
+
+
+def _bits_codec(field_type, bits):
+    # returns (decoder, encoder) between the masked integer value of a
+    # bit-packed field and its python value
+    num_bytes = (bits - 1) // 8 + 1
+    if field_type is FieldType.uint:
+        return None, None
+    elif field_type is FieldType.bool:
+        return bool, lambda value: 1 if value else 0
+    else:
+        return (
+            lambda value: field_type.from_bytes(value.to_bytes(num_bytes, 'little')),
+            lambda value: int.from_bytes(
+                field_type.to_bytes(value, num_bytes)[:num_bytes], 'little'
+            ),
+        )
+
+
+def _group_codec(num_bytes):
+    # returns (struct code, decoder, encoder) for a group of bit-packed fields
+    if num_bytes in _UINT_CODES:
+        return _UINT_CODES[num_bytes], None, None
+    else:
+        return (
+            '{}s'.format(num_bytes),
+            lambda value: int.from_bytes(value, 'little'),
+            lambda value: value.to_bytes(num_bytes, 'little'),
+        )
+
+
+def _array_typecode(field_type, num_bytes):
+    for typecode in _ARRAY_TYPECODES.get(field_type, ''):
+        if array(typecode).itemsize == num_bytes:
+            return typecode
+
+
+def _array_codec(field):
+    # returns (decoder, encoder, values per element) between the bytes of all elements of
+    # a repeated field and its python value, numeric elements and Bitfields that only
+    # consist of integers of the same size are decoded in one step to a flat array.array
+    # of all values, everything else to a tuple with one value per element
+    num_bytes = field.bits // 8
+    element_bytes = num_bytes // field.count
+    typecode = None
+    per_element = 1
+    if _issubclass(field.type, Bitfield):
+        fmt = field.type._format
+        if field.type._direct and len(set(fmt)) == 1 and fmt[0] in 'bBhHiIqQ':
+            field_type = FieldType.uint if fmt[0].isupper() else FieldType.int
+            typecode = _array_typecode(field_type, struct.calcsize(fmt[0]))
+            per_element = len(fmt)
+    else:
+        typecode = _array_typecode(field.type, element_bytes)
+
+    def pad(data):
+        if len(data) > num_bytes:
+            raise ValueError('too many elements for field {}'.format(field.name))
+        return data + bytes(num_bytes - len(data))
+
+    if typecode is not None:
+        def decode(data):
+            values = array(typecode)
+            values.frombytes(data)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            return values
+
+        def encode(values):
+            if not isinstance(values, array) or values.typecode != typecode:
+                values = array(typecode, values)
+            elif sys.byteorder == 'big':
+                values = array(typecode, values)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            return pad(values.tobytes())
+
+    elif _issubclass(field.type, Bitfield):
+        element_type = field.type
+
+        def decode(data):
+            return tuple(
+                element_type.from_bytes(data, offset)
+                for offset in range(0, num_bytes, element_bytes)
+            )
+
+        def encode(values):
+            return pad(b''.join(value.to_bytes() for value in values))
+
+    else:
+        code, element_decode, element_encode = _field_codec(field.type, element_bytes)
+        element = struct.Struct('<' + code)
+
+        def decode(data):
+            values = (value for value, in element.iter_unpack(data))
+            if element_decode is not None:
+                values = map(element_decode, values)
+            return tuple(values)
+
+        def encode(values):
+            if element_encode is not None:
+                values = map(element_encode, values)
+            return pad(b''.join(element.pack(value) for value in values))
+
+    return decode, encode, per_element
+
+
+def _field_reader(code, decode, offset):
+    unpack_from = struct.Struct('<' + code).unpack_from
+    if decode is None:
+        return lambda buffer, base: unpack_from(buffer, base + offset)[0]
+    else:
+        return lambda buffer, base: decode(unpack_from(buffer, base + offset)[0])
+
+
+def _bits_reader(code, group_decode, shift, mask, decode, offset):
+    unpack_from = struct.Struct('<' + code).unpack_from
+
+    def read(buffer, base):
+        value = unpack_from(buffer, base + offset)[0]
+        if group_decode is not None:
+            value = group_decode(value)
+        value = (value >> shift) & mask
+        if decode is not None:
+            value = decode(value)
+        return value
+
+    return read
+
+
+def _nested_reader(bitfield, offset):
+    return lambda buffer, base: bitfield.view(buffer, base + offset)
+
+
+def _array_reader(num_bytes, decode, offset, readers, length_index, per_element):
+    unpack_from = struct.Struct('<{}s'.format(num_bytes)).unpack_from
+
+    def read(buffer, base):
+        value = decode(unpack_from(buffer, base + offset)[0])
+        if length_index is not None:
+            value = value[:readers[length_index](buffer, base) * per_element]
+        return value
+
+    return read
+
+
+def _compile_plan(fields):
+    formats = []
+    steps = []
+    # functions that decode a single field from a buffer, used by lazy views
+    readers = []
+    # index of the value of every named field, for fields that give the length of another
+    indices = {}
+    group = []
+    group_bits = 0
+    offset = 0
+
+    for field in fields:
+        if field.count is not None and field.name is not RESERVED:
+            if group:
+                raise ValueError('repeated fields must be byte aligned')
+            length_index = None
+            if field.length is not None:
+                length_index = indices.get(field.length)
+                if length_index is None:
+                    raise ValueError('length field {} must come first'.format(field.length))
+            num_bytes = field.bits // 8
+            decode, encode, per_element = _array_codec(field)
+            formats.append('{}s'.format(num_bytes))
+            indices[field.name] = len(readers)
+            steps.append((_ARRAY, len(readers), decode, encode, length_index, per_element))
+            readers.append(
+                _array_reader(num_bytes, decode, offset, readers, length_index, per_element)
+            )
+            offset += num_bytes
+            continue
+
+        group.append(field)
+        group_bits += field.bits
+        if group_bits % 8 != 0:
+            continue
+
+        num_bytes = group_bits // 8
+        if all(f.name is RESERVED for f in group):
+            formats.append('{}x'.format(num_bytes))
+        elif len(group) == 1:
+            if _issubclass(field.type, Bitfield):
+                formats.append(field.type._format)
+                indices[field.name] = len(readers)
+                steps.append((_NESTED, len(readers), field.type))
+                readers.append(_nested_reader(field.type, offset))
+            else:
+                code, decode, encode = _field_codec(field.type, num_bytes)
+                formats.append(code)
+                indices[field.name] = len(readers)
+                if decode is None:
+                    steps.append((_RAW, len(readers)))
+                else:
+                    steps.append((_CONV, len(readers), decode, encode))
+                readers.append(_field_reader(code, decode, offset))
+        else:
+            code, decode, encode = _group_codec(num_bytes)
+            formats.append(code)
+            parts = []
+            shift = group_bits
+            for pack_field in group:
+                shift -= pack_field.bits
+                if pack_field.name is RESERVED:
+                    continue
+                if _issubclass(pack_field.type, Bitfield):
+                    raise TypeError('nested Bitfield fields must be byte aligned')
+                mask = (1 << pack_field.bits) - 1
+                field_decode, field_encode = _bits_codec(pack_field.type, pack_field.bits)
+                indices[pack_field.name] = len(readers)
+                parts.append((len(readers), shift, mask, field_decode, field_encode))
+                readers.append(_bits_reader(code, decode, shift, mask, field_decode, offset))
+            steps.append((_BITS, decode, encode, parts))
+
+        offset += num_bytes
+        group = []
+        group_bits = 0
+
+    if group:
+        raise ValueError('fields must add up to a whole number of bytes')
+
+    return ''.join(formats), steps, readers
 
 
 class BitfieldMeta(type):
     def __new__(mcs, name, bases, namespace):
+        # values are stored in a tuple, so instances don't need a __dict__
+        namespace.setdefault('__slots__', ())
         if 'fields' in namespace:
             namespace['field_key_list'] = [
                 field.name for field in namespace['fields']
                 if field.name is not RESERVED
             ]
             namespace['field_keys'] = set(namespace['field_key_list'])
+            namespace['_key_index'] = {
+                key: i for i, key in enumerate(namespace['field_key_list'])
+            }
             namespace['total_bytes'] = sum(f.bits for f in namespace['fields']) // 8
 
-            cls = super().__new__(mcs, name, bases, namespace)
-
-            if all(f.bits % 8 == 0 for f in namespace['fields']):
-                cls.to_bytes = cls._to_bytes_simple
-                cls.from_bytes = cls._from_bytes_simple
-            else:
-                cls.to_bytes = cls._to_bytes_full
-                cls.from_bytes = cls._from_bytes_full
+            fmt, steps, readers = _compile_plan(namespace['fields'])
+            namespace['_format'] = fmt
+            namespace['_struct'] = struct.Struct('<' + fmt)
+            namespace['_steps'] = steps
+            namespace['_readers'] = readers
+            # plain byte aligned layouts map the unpacked struct directly to the values
+            namespace['_direct'] = all(step[0] == _RAW for step in steps)
 
-            return cls
-        else:
-            return super().__new__(mcs, name, bases, namespace)
+        return super().__new__(mcs, name, bases, namespace)
 
 
 class Bitfield(object, metaclass=BitfieldMeta):
+    __slots__ = ('_values',)
+
     message_type = None
     fields = []
 
@@ -126,128 +407,327 @@ class Bitfield(object, metaclass=BitfieldMeta):
         if args:
             if len(args) != len(self.field_key_list):
                 raise ValueError('unexpected number of values')
-            kwargs = {
-                key: val for key, val in zip(self.field_key_list, args)
-            }
+            self._values = args
+        else:
+            if set(kwargs.keys()) != self.field_keys:
+                raise ValueError('unexpected keys')
+            self._values = tuple(kwargs[key] for key in self.field_key_list)
 
-        if set(kwargs.keys()) != self.field_keys:
-            raise ValueError('unexpected keys')
+    @classmethod
+    def _make(cls, values):
+        # fast constructor that takes a tuple of all values in field order
+        self = cls.__new__(cls)
+        self._values = values
+        return self
 
-        self._data = kwargs
+    def __reduce__(self):
+        return self.__class__._make, (tuple(self._values),)
 
     def __repr__(self):
         vals = (
-            '{}={!r}'.format(field.name, self._data[field.name])
+            '{}={!r}'.format(field.name, self[field.name])
             for field in self.fields if field.name is not RESERVED
         )
         return '<{} {}>'.format(self.__class__.__name__, ' '.join(vals))
 
-    def to_bytes(self):
-        # gets replaced with _to_bytes_simple or _to_bytes_full by meta class
-        pass
-
-    def _get_value(self, field):
-        num_bytes = (field.bits - 1) // 8 + 1
-        if field.name is RESERVED:
-            return b'\x00' * num_bytes
-        else:
-            value = self._data[field.name]
-            if isinstance(value, Bitfield):
-                return value.to_bytes()
+    def _encode(self, out):
+        data = self._values
+        for step in self._steps:
+            kind = step[0]
+            if kind == _RAW:
+                out.append(data[step[1]])
+            elif kind == _CONV:
+                out.append(step[3](data[step[1]]))
+            elif kind == _ARRAY:
+                values = data[step[1]]
+                if step[4] is not None and len(values) != data[step[4]] * step[5]:
+                    raise ValueError('field {} has {} values but its length field says {}'.format(
+                        self.field_key_list[step[1]], len(values), data[step[4]] * step[5]
+                    ))
+                out.append(step[3](values))
+            elif kind == _BITS:
+                value = 0
+                for index, shift, mask, decode, encode in step[3]:
+                    field_value = data[index]
+                    if encode is not None:
+                        field_value = encode(field_value)
+                    value |= (field_value & mask) << shift
+                if step[2] is not None:
+                    value = step[2](value)
+                out.append(value)
             else:
-                return field.type.to_bytes(value, num_bytes)
-
-    def _to_bytes_simple(self):
-        return b''.join(self._get_value(field) for field in self.fields)
+                data[step[1]]._encode(out)
 
-    def _to_bytes_full(self):
-        byte_data = b''
-        packed_bits = 0
-        pack = []
-        for field in self.fields:
-            packed_bits += field.bits
-            pack.append((self._get_value(field), field.bits))
+    def _pack_values(self):
+        if self._direct:
+            return self._values
+        out = []
+        self._encode(out)
+        return out
 
-            if packed_bits % 8 == 0:
-                packed_val = 0
-                for val, bits in pack:
-                    val = int.from_bytes(val[:(bits - 1) // 8 + 1], 'little')
-                    packed_val <<= bits
-                    packed_val |= val & ((1 << bits) - 1)
-
-                byte_data += packed_val.to_bytes(packed_bits // 8, 'little')
-                packed_bits = 0
-                pack = []
+    def to_bytes(self):
+        return self._struct.pack(*self._pack_values())
 
-        return byte_data
+    def pack_into(self, buffer, offset=0):
+        self._struct.pack_into(buffer, offset, *self._pack_values())
 
     @classmethod
-    def from_bytes(cls, data):
-        # gets replaced with _from_bytes_simple or _from_bytes_full
-        # by meta class
-        pass
+    def _decode(cls, values, pos):
+        if cls._direct:
+            end = pos + len(cls._steps)
+            return cls._make(values[pos:end]), end
+
+        data = []
+        for step in cls._steps:
+            kind = step[0]
+            if kind == _RAW:
+                data.append(values[pos])
+            elif kind == _CONV:
+                data.append(step[2](values[pos]))
+            elif kind == _ARRAY:
+                value = step[2](values[pos])
+                if step[4] is not None:
+                    value = value[:data[step[4]] * step[5]]
+                data.append(value)
+            elif kind == _BITS:
+                value = values[pos]
+                if step[1] is not None:
+                    value = step[1](value)
+                for index, shift, mask, decode, encode in step[3]:
+                    field_value = (value >> shift) & mask
+                    if decode is not None:
+                        field_value = decode(field_value)
+                    data.append(field_value)
+            else:
+                value, pos = step[2]._decode(values, pos)
+                data.append(value)
+                continue
+            pos += 1
+
+        return cls._make(tuple(data)), pos
 
     @classmethod
-    def _from_bytes_simple(cls, data):
-        if len(data) < cls.total_bytes:
+    def from_bytes(cls, data, offset=0):
+        if len(data) - offset < cls.total_bytes:
             raise ValueError('missing data')
-        bytes_data = iter(bytes(data))
-        bitfield_data = {}
-        for field in cls.fields:
-            field_bytes = bytes(islice(bytes_data, field.bits // 8))
-            if field.name is not RESERVED:
-                bitfield_data[field.name] = field.type.from_bytes(field_bytes)
-
-        return cls(**bitfield_data)
+        values = cls._struct.unpack_from(data, offset)
+        return cls._decode(values, 0)[0]
 
     @classmethod
-    def _from_bytes_full(cls, data):
-        if len(data) < cls.total_bytes:
+    def view(cls, data, offset=0):
+        if len(data) - offset < cls.total_bytes:
             raise ValueError('missing data')
-        bytes_data = iter(bytes(data))
-        bitfield_data = {}
-        packed_bits = 0
-        pack = []
-        for field in cls.fields:
-            packed_bits += field.bits
-            pack.append(field)
-
-            if packed_bits % 8 == 0:
-                pack_bytes = bytes(islice(bytes_data, packed_bits // 8))
-                value = int.from_bytes(pack_bytes, 'little')
-                for pack_field in reversed(pack):
-                    if pack_field.name is not RESERVED:
-                        int_val = value & ((1 << pack_field.bits) - 1)
-                        num_bytes = (pack_field.bits - 1) // 8 + 1
-                        bytes_val = int_val.to_bytes(num_bytes, 'little')
-                        bitfield_data[pack_field.name] = pack_field.type.from_bytes(bytes_val)
-
-                    value >>= pack_field.bits
-
-                packed_bits = 0
-                pack = []
-
-        return cls(**bitfield_data)
+        view_class = cls.__dict__.get('_view_class')
+        if view_class is None:
+            view_class = type(cls)(
+                cls.__name__, (_BitfieldView, cls), {'__slots__': ('_buffer', '_offset')}
+            )
+            view_class._view_class = view_class
+            cls._view_class = view_class
+        return view_class(data, offset)
 
     def __bytes__(self):
         return self.to_bytes()
 
     def __getitem__(self, key):
-        return self._data[key]
+        return self._values[self._key_index[key]]
+
+    def __setitem__(self, key, value):
+        index = self._key_index.get(key)
+        if index is None:
+            raise ValueError('invalid key')
+        values = list(self._values)
+        values[index] = value
+        self._values = tuple(values)
+
+
+# marks fields of a view that have not been decoded yet
+_MISSING = object()
+
+
+class _BitfieldView(object):
+    # mixed into a Bitfield subclass by Bitfield.view(), it keeps a reference to the
+    # buffer and only decodes the fields that are accessed
+    __slots__ = ()
+
+    def __init__(self, data, offset):
+        self._buffer = data
+        self._offset = offset
+        self._values = [_MISSING] * len(self.field_key_list)
+
+    def __reduce__(self):
+        self._load()
+        return self.__class__.__bases__[1]._make, (tuple(self._values),)
+
+    def _load(self):
+        for key in self.field_key_list:
+            self[key]
+
+    def _encode(self, out):
+        self._load()
+        super()._encode(out)
+
+    def _pack_values(self):
+        self._load()
+        return super()._pack_values()
+
+    def __getitem__(self, key):
+        index = self._key_index[key]
+        value = self._values[index]
+        if value is _MISSING:
+            value = self._readers[index](self._buffer, self._offset)
+            self._values[index] = value
+        return value
 
     def __setitem__(self, key, value):
-        if key not in self.field_keys:
+        index = self._key_index.get(key)
+        if index is None:
             raise ValueError('invalid key')
-        self._data[key] = value
+        self._values[index] = value
+
+
+class _Flight(object):
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MethodCache(object):
+    # results of one method per instance, they expire after ttl seconds (never if ttl is
+    # None) and the least recently used results are evicted once there are maxsize of them,
+    # instances are only referenced weakly and their results are dropped with them
+    def __init__(self, ttl=None, maxsize=16384):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # calls in progress per instance, concurrent misses wait for them
+        self.flights = {}
+        # weak references to the instances in least recently used order
+        self._entries = OrderedDict()
+        # references of collected instances, they are removed the next time the lock is held
+        # because the garbage collector might run while it is held already
+        self._dead = []
+
+    def __len__(self):
+        with self.lock:
+            self._remove_dead()
+            return len(self._entries)
+
+    def _remove_dead(self):
+        while self._dead:
+            self._entries.pop(self._dead.pop(), None)
+
+    def get(self, instance):
+        # returns an (expires, value) tuple or None
+        ref = weakref.ref(instance)
+        with self.lock:
+            self._remove_dead()
+            entry = self._entries.get(ref)
+            if entry is not None:
+                if entry[0] is None or entry[0] > time.monotonic():
+                    self._entries.move_to_end(ref)
+                    return entry
+                del self._entries[ref]
+
+    def set(self, instance, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        ref = weakref.ref(instance, self._dead.append)
+        with self.lock:
+            self._remove_dead()
+            # an existing entry keeps its own reference and callback
+            self._entries[ref] = expires, value
+            self._entries.move_to_end(ref)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, instance=None):
+        with self.lock:
+            self._remove_dead()
+            if instance is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(weakref.ref(instance), None)
 
 
-def cache_method(meth):
-    name = '__cache_method_{}'.format(meth.__name__)
+def cache_method(meth=None, ttl=None, maxsize=16384):
+    # caches the result of a method without arguments per instance, can be used as
+    # @cache_method or @cache_method(ttl=60), the cache is available as func.cache
+    if meth is None:
+        return functools.partial(cache_method, ttl=ttl, maxsize=maxsize)
+    cache = MethodCache(ttl, maxsize)
 
     @functools.wraps(meth)
     def func(self):
-        if name not in self.__dict__:
-            self.__dict__[name] = meth(self)
-        return self.__dict__[name]
-
+        entry = cache.get(self)
+        if entry is not None:
+            return entry[1]
+
+        with cache.lock:
+            flight = cache.flights.get(self)
+            leader = flight is None
+            if leader:
+                flight = cache.flights[self] = _Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = meth(self)
+            cache.set(self, flight.value)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with cache.lock:
+                del cache.flights[self]
+            flight.event.set()
+        return flight.value
+
+    func.cache = cache
     return func
+
+
+def invalidate_cached_methods(instance, names=()):
+    # forgets the cached results of instance for the given method names, or for all of its
+    # cached methods
+    cls = type(instance)
+    for name in names or dir(cls):
+        cache = getattr(getattr(cls, name, None), 'cache', None)
+        if isinstance(cache, MethodCache):
+            cache.invalidate(instance)
+
+
+class RttEstimator(object):
+    # smoothed round trip time and retransmission timeout as described in RFC 6298
+    __slots__ = ('srtt', 'rttvar', 'initial_rto', 'min_rto', 'max_rto')
+
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, initial_rto=1.0, min_rto=0.1, max_rto=60.0):
+        self.srtt = None
+        self.rttvar = None
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+    def rto(self, attempt=0):
+        # timeout for the given retransmission, doubled for every earlier attempt
+        if self.srtt is None:
+            rto = self.initial_rto
+        else:
+            rto = self.srtt + 4 * self.rttvar
+        return min(max(rto, self.min_rto) * 2 ** attempt, self.max_rto)
@@ -1,10 +1,35 @@
 #!/usr/bin/env python
 
+import asyncio
+import gc
+import pickle
+import queue
 import struct
+import threading
+import time
 import unittest
+import weakref
+from array import array
+from unittest import mock
 
-from licht.base import LightColor
-from licht.utils import RESERVED, Bitfield, Field, FieldType
+from licht import colors
+from licht.base import (
+    Backend, Light, LightChange, LightColor, LightGroup, LightPower, LightStatus, LightWhite,
+)
+from licht.effects import Effect, EffectsEngine
+from licht.exceptions import LichtError, LichtTimeoutError
+from licht.lifx import (
+    HSBK, AckMode, Header, LifxBackend, LightIndex, LightPoller, LightSetColor, LightState,
+    MessageType, Priority, Set64, SetExtendedColorZones, StateExtendedColorZones, StatePower,
+    StateService, _Discovery, _PendingRequest, _ResponseRouter, _SendScheduler,
+)
+from licht.lifx_async import AsyncLifxBackend
+from licht.metrics import Histogram, RequestOutcome
+from licht.simulator import LifxSimulator
+from licht.utils import (
+    RESERVED, Bitfield, Field, FieldType, RttEstimator, cache_method,
+    invalidate_cached_methods,
+)
 
 
 class BitFieldTest(unittest.TestCase):
@@ -45,10 +70,31 @@ class BitFieldTest(unittest.TestCase):
                 Field('bar', 3, FieldType.uint),
             ]
 
+        class OddSizeBitfield(Bitfield):
+            fields = [
+                Field('foo', 24, FieldType.uint),
+                Field('bar', 4, FieldType.uint),
+                Field('baz', 20, FieldType.uint),
+                Field('fiz', 16, FieldType.bool),
+            ]
+
+        class NestedBitfield(Bitfield):
+            fields = [
+                Field('foo', 8, FieldType.uint),
+                Field('bar', type=ReservedFullBitfield),
+                Field('baz', type=SimpleBitfield),
+            ]
+
+        class InheritedBitfield(SimpleBitfield):
+            pass
+
         cls.SimpleBitfield = SimpleBitfield
         cls.FullBitfield = FullBitfield
         cls.ReservedSimpleBitfield = ReservedSimpleBitfield
         cls.ReservedFullBitfield = ReservedFullBitfield
+        cls.OddSizeBitfield = OddSizeBitfield
+        cls.NestedBitfield = NestedBitfield
+        cls.InheritedBitfield = InheritedBitfield
 
     def test_to_bytes_simple(self):
         f = self.SimpleBitfield(foo=1234, bar=b'hello!', baz=3.14)
@@ -90,6 +136,930 @@ class BitFieldTest(unittest.TestCase):
         f = self.ReservedFullBitfield.from_bytes(data)
         self.assertFieldsEqual(f, {'foo': 3456, 'bar': 3})
 
+    def test_odd_sizes(self):
+        f = self.OddSizeBitfield(foo=0x123456, bar=5, baz=0xabcde, fiz=True)
+        expected = b'\x56\x34\x12' + ((5 << 20) | 0xabcde).to_bytes(3, 'little') + b'\x01\x00'
+        self.assertEqual(f.to_bytes(), expected)
+
+        f = self.OddSizeBitfield.from_bytes(expected)
+        self.assertFieldsEqual(f, {'foo': 0x123456, 'bar': 5, 'baz': 0xabcde, 'fiz': True})
+
+    def test_nested(self):
+        simple = self.SimpleBitfield(foo=-1, bar=b'nested', baz=0.5)
+        f = self.NestedBitfield(foo=7, bar=self.ReservedFullBitfield(foo=3456, bar=3), baz=simple)
+        data = f.to_bytes()
+        self.assertEqual(data, b'\x07\x80\x0d\x03' + simple.to_bytes())
+
+        f = self.NestedBitfield.from_bytes(data)
+        self.assertEqual(f['foo'], 7)
+        self.assertFieldsEqual(f['bar'], {'foo': 3456, 'bar': 3})
+        self.assertFieldsEqual(f['baz'], {'foo': -1, 'bar': b'nested', 'baz': 0.5})
+
+    def test_inherited(self):
+        value = (12).to_bytes(2, 'little') + b'foobar' + struct.pack('<d', 1.5)
+        f = self.InheritedBitfield.from_bytes(value)
+        self.assertIsInstance(f, self.InheritedBitfield)
+        self.assertFieldsEqual(f, {'foo': 12, 'bar': b'foobar', 'baz': 1.5})
+
+    def test_offset(self):
+        f = self.FullBitfield(foo=False, bar=42, baz=4242, fiz=0.25)
+        buf = bytearray(20)
+        f.pack_into(buf, 4)
+        self.assertEqual(bytes(buf[4:16]), f.to_bytes())
+        self.assertEqual(bytes(buf[:4]) + bytes(buf[16:]), b'\x00' * 8)
+
+        f = self.FullBitfield.from_bytes(memoryview(buf), 4)
+        self.assertFieldsEqual(f, {'foo': False, 'bar': 42, 'baz': 4242, 'fiz': 0.25})
+
+        with self.assertRaises(ValueError):
+            self.FullBitfield.from_bytes(buf, 10)
+
+    def test_view(self):
+        simple = self.SimpleBitfield(foo=-1, bar=b'nested', baz=0.5)
+        data = self.NestedBitfield(
+            foo=7, bar=self.ReservedFullBitfield(foo=3456, bar=3), baz=simple
+        ).to_bytes()
+
+        f = self.NestedBitfield.view(b'xx' + data, 2)
+        self.assertIsInstance(f, self.NestedBitfield)
+        self.assertEqual(f['bar']['bar'], 3)
+        self.assertEqual(f['baz']['bar'], b'nested')
+        self.assertNotIn(7, f._values)
+        self.assertFieldsEqual(f['baz'], {'foo': -1, 'bar': b'nested', 'baz': 0.5})
+        self.assertEqual(f.to_bytes(), data)
+
+        f['foo'] = 8
+        self.assertEqual(f.to_bytes(), b'\x08' + data[1:])
+
+        with self.assertRaises(ValueError):
+            self.NestedBitfield.view(data, 1)
+
+    def test_storage(self):
+        f = self.SimpleBitfield(1, b'foo', 2.5)
+        self.assertFalse(hasattr(f, '__dict__'))
+
+        hsbk = HSBK(1, 2, 3, 4)
+        for value in (hsbk, HSBK.view(hsbk.to_bytes())):
+            copy = pickle.loads(pickle.dumps(value))
+            self.assertIs(type(copy), HSBK)
+            self.assertEqual(copy.to_bytes(), hsbk.to_bytes())
+
+        f['foo'] = 2
+        self.assertFieldsEqual(f, {'foo': 2, 'bar': b'foo', 'baz': 2.5})
+        with self.assertRaises(ValueError):
+            f['fiz'] = 3
+
+        with self.assertRaises(ValueError):
+            self.SimpleBitfield(1, b'foo')
+        with self.assertRaises(ValueError):
+            self.SimpleBitfield(foo=1, bar=b'foo', fiz=2.5)
+        with self.assertRaises(ValueError):
+            self.SimpleBitfield(1, b'foo', baz=2.5)
+
+    def test_repeated_fields(self):
+        class ArrayBitfield(Bitfield):
+            fields = [
+                Field('count', 8, FieldType.uint),
+                Field('values', 16, FieldType.uint, count=4, length='count'),
+                Field('floats', 32, FieldType.float, count=2),
+                Field('colors', type=HSBK, count=3, length='count'),
+                Field('flags', 8, FieldType.bool, count=2),
+            ]
+
+        self.assertEqual(ArrayBitfield.total_bytes, 1 + 8 + 8 + 24 + 2)
+        f = ArrayBitfield(2, [1, 2], [0.5, 1.5], [1, 2, 3, 4, 5, 6, 7, 8], [True, False])
+        data = f.to_bytes()
+        self.assertEqual(len(data), ArrayBitfield.total_bytes)
+        self.assertEqual(data[1:9], struct.pack('<4H', 1, 2, 0, 0))
+        self.assertEqual(data[17:33], HSBK(1, 2, 3, 4).to_bytes() + HSBK(5, 6, 7, 8).to_bytes())
+        self.assertEqual(data[33:41], bytes(8))
+
+        for value in (ArrayBitfield.from_bytes(data), ArrayBitfield.view(data)):
+            self.assertEqual(list(value['values']), [1, 2])
+            self.assertEqual(list(value['floats']), [0.5, 1.5])
+            self.assertEqual(list(value['colors']), [1, 2, 3, 4, 5, 6, 7, 8])
+            self.assertEqual(value['flags'], (True, False))
+            self.assertEqual(value.to_bytes(), data)
+
+        with self.assertRaises(ValueError):
+            ArrayBitfield(5, range(5), [], range(20), []).to_bytes()
+
+        # the length field must match the number of elements
+        for values, hsbk in (([1, 2, 3], [1, 2, 3, 4] * 2), ([1, 2], [1, 2, 3, 4])):
+            with self.assertRaises(ValueError):
+                ArrayBitfield(2, values, [], hsbk, []).to_bytes()
+
+        with self.assertRaises(ValueError):
+            class MissingLengthBitfield(Bitfield):
+                fields = [
+                    Field('values', 16, FieldType.uint, count=4, length='count'),
+                    Field('count', 8, FieldType.uint),
+                ]
+
+        with self.assertRaises(ValueError):
+            class UnalignedArrayBitfield(Bitfield):
+                fields = [
+                    Field('foo', 4, FieldType.uint),
+                    Field('values', 16, FieldType.uint, count=4),
+                    Field('bar', 4, FieldType.uint),
+                ]
+
+    def test_missing_data(self):
+        with self.assertRaises(ValueError):
+            self.SimpleBitfield.from_bytes(b'\x00' * 15)
+
+    def test_unaligned_fields(self):
+        with self.assertRaises(ValueError):
+            class UnalignedBitfield(Bitfield):
+                fields = [
+                    Field('foo', 7, FieldType.uint),
+                ]
+
+
+class LifxPacketTest(unittest.TestCase):
+    def test_make_packet(self):
+        target = b'\xd0\x73\xd5\x01\x02\x03\x00\x00'
+        payload = LightSetColor(HSBK(1, 2, 3, 4), 500)
+        packet = LifxBackend(b'lcht')._make_packet(target, 7, payload, True, True)
+        self.assertEqual(len(packet), Header.total_bytes + LightSetColor.total_bytes)
+
+        header = Header.from_bytes(packet)
+        self.assertEqual(header['frame']['size'], len(packet))
+        self.assertEqual(header['frame']['source'], b'lcht')
+        self.assertFalse(header['frame']['tagged'])
+        self.assertEqual(header['frame_address']['target'], target)
+        self.assertTrue(header['frame_address']['ack_required'])
+        self.assertTrue(header['frame_address']['res_required'])
+        self.assertEqual(header['frame_address']['sequence'], 7)
+        self.assertIs(header.payload_type, MessageType.LightSetColor)
+        self.assertEqual(bytes(packet[Header.total_bytes:]), payload.to_bytes())
+
+    def test_make_packet_broadcast(self):
+        packet = LifxBackend(b'lcht')._make_packet(None, 0, MessageType.GetService)
+        self.assertEqual(len(packet), Header.total_bytes)
+        header = Header.from_bytes(packet)
+        self.assertTrue(header['frame']['tagged'])
+        self.assertEqual(header['frame_address']['target'], b'\x00' * 8)
+
+    def test_make_packet_cached(self):
+        backend = LifxBackend(b'lcht')
+        payload = LightSetColor(HSBK(1, 2, 3, 4), 500)
+        first = backend._make_packet(b'\x01' * 8, 1, payload, True)
+        second = backend._make_packet(b'\x01' * 8, 2, payload, True)
+        self.assertEqual(first[:23], second[:23])
+        self.assertEqual(Header.from_bytes(second)['frame_address']['sequence'], 2)
+        self.assertEqual(len(backend._header_cache), 1)
+
+    def test_make_packets(self):
+        backend = LifxBackend(b'lcht')
+        payloads = [
+            (b'\x01' * 8, 1, LightSetColor(HSBK(1, 2, 3, 4), 500)),
+            (None, 2, MessageType.GetService),
+            (b'\x02' * 8, 3, LightSetColor(HSBK(5, 6, 7, 8), 0)),
+        ]
+        packets = backend._make_packets(payloads, ack=True)
+        self.assertEqual(len(packets), 3)
+        for packet, (target, seq, payload) in zip(packets, payloads):
+            self.assertEqual(packet, backend._make_packet(target, seq, payload, True))
+        self.assertIs(packets[0].obj, packets[2].obj)
+
+    def test_parse_response(self):
+        packet = LifxBackend(b'lcht')._make_packet(b'\x01' * 8, 1, StateService(1, 56700))
+        self.assertIsNone(LifxBackend._parse_response(packet, MessageType.StatePower))
+        header, service = LifxBackend._parse_response(packet, MessageType.StateService)
+        self.assertEqual(header['frame_address']['sequence'], 1)
+        self.assertEqual((service['service'], service['port']), (1, 56700))
+
+    def test_zone_packets(self):
+        backend = LifxBackend(b'lcht')
+        self.assertEqual(SetExtendedColorZones.total_bytes, 8 + 82 * 8)
+        self.assertEqual(Set64.total_bytes, 10 + 64 * 8)
+
+        packet = backend._zones_packet(colors.hsb_to_hsbk([(0, 1, 1), (180, 1, 1)]), 100, 5)
+        self.assertEqual(packet['colors_count'], 2)
+        data = packet.to_bytes()
+        red, cyan = HSBK(0, 65535, 65535, 3500), HSBK(32767, 65535, 65535, 3500)
+        self.assertEqual(data[8:24], red.to_bytes() + cyan.to_bytes())
+        self.assertEqual(data[24:], bytes(80 * 8))
+        with self.assertRaises(ValueError):
+            backend._zones_packet([0] * 4 * 83, 0, 0)
+        with self.assertRaises(ValueError):
+            backend._tile_packet([0] * 6, 0, 0, 0, 0, 8)
+
+        # 100 zones arrive in two packets
+        hsbk = array('H', range(400))
+        handle = backend._zones_handler()
+        for index in (82, 0):
+            zones = hsbk[4 * index:4 * min(index + 82, 100)]
+            state = StateExtendedColorZones(100, index, len(zones) // 4, zones)
+            result = handle(
+                MessageType.StateExtendedColorZones, backend._make_packet(b'\x01' * 8, 1, state)
+            )
+        self.assertEqual(result, hsbk)
+
+
+class LifxBackendTest(unittest.TestCase):
+    def test_shared_socket(self):
+        with LifxBackend() as backend:
+            sock = backend._get_shared_socket()
+            self.assertIs(backend._get_shared_socket(), sock)
+
+        with self.assertRaises(LichtError):
+            backend._get_shared_socket()
+
+    def test_router_keys(self):
+        router = _ResponseRouter(b'lcht')
+        keys = {router.register(None) for _ in range(256)}
+        self.assertEqual(keys, {(b'lcht', seq) for seq in range(256)})
+
+        source, seq = router.register(None)
+        self.assertNotEqual(source, b'lcht')
+        self.assertEqual(len(router.sources), 2)
+
+        # freed keys are only reused once all other keys are taken
+        router.unregister(b'lcht', 5)
+        keys = {router.register(None) for _ in range(255)}
+        self.assertEqual(keys, {(source, seq) for seq in range(1, 256)})
+        self.assertEqual(router.register(None), (b'lcht', 5))
+
+    def test_router_route(self):
+        backend = LifxBackend(b'lcht')
+        router = _ResponseRouter(b'lcht')
+        received = []
+        source, seq = router.register(received.append)
+
+        for packet_source, packet_seq in ((source, seq + 1), (b'othr', seq), (source, seq)):
+            packet = backend._make_packet(
+                b'\x01' * 8, packet_seq, StateService(1, 56700), source=packet_source
+            )
+            router.route(packet, ('127.0.0.1', 56700))
+        router.route(b'', ('127.0.0.1', 56700))
+
+        self.assertEqual(len(received), 1)
+        msg_type, data, addr = received[0]
+        self.assertEqual(msg_type, MessageType.StateService)
+        self.assertEqual(Header.from_bytes(data)['frame_address']['sequence'], seq)
+
+    def test_discovery(self):
+        backend = LifxBackend(b'lcht')
+        discovery = _Discovery(backend, timeout=10, count=1)
+        broadcast, wait = discovery.poll()
+        self.assertTrue(broadcast)
+        self.assertAlmostEqual(wait, 10 / backend.tries, places=1)
+        self.assertEqual(discovery.poll()[0], False)
+
+        packet = backend._make_packet(b'\x01' * 8, 0, StateService(1, 56700))
+        self.assertEqual(discovery.add(packet, '10.0.0.1'), ('10.0.0.1', 56700, b'\x01' * 8))
+        self.assertIsNone(discovery.add(packet, '10.0.0.1'))
+        self.assertEqual(discovery.poll(), (False, None))
+
+        discovery = _Discovery(backend, timeout=10, quiet=0)
+        self.assertEqual(discovery.poll(), (False, None))
+
+    def test_ack_modes(self):
+        backend = LifxBackend(b'lcht', ack_mode=AckMode.ACK)
+        addr = ('10.0.0.1', 56700, b'\x01' * 8)
+        packet = LightSetColor(HSBK(1, 2, 3, 4), 0)
+        state = {'color': HSBK(0, 0, 65535, 3500)}
+        white = LightWhite(1, 3500)
+
+        request = backend._set_request(addr, packet, MessageType.LightState)
+        self.assertEqual(request[3:], (True, False))
+        self.assertEqual(backend._set_result(None, None, white, None), white)
+
+        request = backend._set_request(addr, packet, MessageType.LightState, AckMode.STATE)
+        self.assertEqual(request[3:], (True, True))
+        self.assertEqual(
+            backend._set_result(AckMode.STATE, state, None, backend._color_from_state), white
+        )
+
+        request = backend._set_request(addr, packet, MessageType.LightState, AckMode.NONE)
+        self.assertEqual(request[2:], (None, False, False))
+        self.assertIsNone(backend._set_result(AckMode.NONE, None, white, None))
+
+    def test_set_handler(self):
+        backend = LifxBackend(b'lcht')
+        target = b'\x01' * 8
+        handle = backend._set_handler(MessageType.StatePower)
+        self.assertIsNone(handle(MessageType.Acknowledgement, b''))
+        # a truncated state is ignored like any other packet that can't be parsed
+        truncated = backend._make_packet(target, 0, MessageType.StatePower)
+        self.assertIsNone(handle(MessageType.StatePower, truncated))
+        result = handle(MessageType.StatePower, backend._make_packet(target, 0, StatePower(65535)))
+        self.assertEqual(result[0]['level'], 65535)
+
+    def test_state_cache(self):
+        backend = LifxBackend(b'lcht', state_ttl=60)
+        addr = ('10.0.0.1', 56700, b'\x01' * 8)
+        state = LightState(HSBK(0, 0, 65535, 3500), 65535, b'Kitchen'.ljust(32, b'\x00'))
+        packet = backend._make_packet(b'\x01' * 8, 0, state)
+        handle = backend._state_handler(MessageType.LightState)
+        self.assertIsNotNone(handle(MessageType.LightState, packet))
+
+        status = LightStatus(LightPower.ON, LightWhite(1, 3500), 'Kitchen')
+        self.assertEqual(backend._get_cached_status(addr), status)
+        self.assertIsNone(backend._get_cached_state(('10.0.0.2', 56700, b'\x02' * 8), 'power'))
+
+        # writes make the cached value stale
+        backend._set_request(addr, LightSetColor(HSBK(1, 2, 3, 4), 0), MessageType.LightState)
+        self.assertIsNone(backend._get_cached_state(addr, 'color'))
+        self.assertEqual(backend._get_cached_state(addr, 'power'), LightPower.ON)
+
+        backend.state_ttl = 0
+        handle(MessageType.LightState, packet)
+        self.assertIsNone(backend._get_cached_status(addr))
+
+    def test_poller_changes(self):
+        changes = []
+        poller = LightPoller(None, ['light'], interval=1, jitter=0, callback=changes.append)
+        entry = poller._entries['light']
+        status = LightStatus(LightPower.ON, LightWhite(1, 3500), 'Kitchen')
+
+        poller._update(entry, status, 100)
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(entry.due, 101)
+
+        poller._update(entry, status._replace(power=LightPower.OFF), 101)
+        self.assertEqual(
+            changes[3:], [LightChange('light', 'power', LightPower.ON, LightPower.OFF)]
+        )
+        self.assertEqual(poller.get_status('light').power, LightPower.OFF)
+
+        # errors in the callback are logged and don't stop the poller
+        poller.callback = lambda change: 1 / 0
+        with self.assertLogs('licht.lifx', 'ERROR'):
+            poller._update(entry, status, 102)
+        self.assertEqual(entry.status, status)
+        poller.callback = changes.append
+
+        # lights that don't respond are polled less often
+        delays = []
+        for _ in range(7):
+            poller._update(entry, None, 0)
+            delays.append(entry.due)
+        self.assertEqual(delays, [2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(len(changes), 4)
+
+    def test_light_registry(self):
+        backend = LifxBackend(b'lcht')
+        light = backend._register_light(('10.0.0.1', 56700, b'\x01' * 8))
+        self.assertIs(backend._register_light(('10.0.0.1', 56700, b'\x01' * 8)), light)
+        self.assertIsNot(backend._register_light(('10.0.0.1', 56700, b'\x02' * 8)), light)
+
+        # the light moved to another host
+        self.assertIs(backend._register_light(('10.0.0.7', 56700, b'\x01' * 8)), light)
+        self.assertEqual(light.addr, ('10.0.0.7', 56700, b'\x01' * 8))
+        self.assertEqual(len(backend.get_known_lights()), 2)
+
+        # lights can carry attributes of their users and be referenced weakly
+        light.room = 'Kitchen'
+        self.assertIs(weakref.ref(light)(), light)
+
+    def test_light_index(self):
+        backend = LifxBackend(b'lcht')
+        lights = [
+            backend._register_light(('10.0.0.{}'.format(i), 56700, bytes([i]) * 8))
+            for i in range(3)
+        ]
+        index = LightIndex(backend)
+        kitchen, hall = b'k' * 16, b'h' * 16
+        index.update(lights[0], 'group', (kitchen, 'Kitchen', 1))
+        index.update(lights[1], 'group', (kitchen, 'Kitchen', 1))
+        index.update(lights[2], 'group', (hall, 'Hall', 1))
+        index.update(lights[2], 'location', (b'l' * 16, 'Home', 1))
+
+        self.assertEqual(set(index.get_group('Kitchen')), set(lights[:2]))
+        self.assertEqual(set(index.get_group(hall)), {lights[2]})
+        self.assertEqual(len(index.get_location('Home')), 1)
+        self.assertEqual(lights[0].get_group(), (kitchen, 'Kitchen', 1))
+        with self.assertRaises(KeyError):
+            index.get_group('Bedroom')
+
+        # the group was renamed and one light was moved to another group
+        index.update(lights[0], 'group', (kitchen, 'Dining', 2))
+        index.update(lights[1], 'group', (hall, 'Hall', 1))
+        self.assertEqual(index.get_groups(), {kitchen: 'Dining', hall: 'Hall'})
+        self.assertEqual(set(index.get_group('Hall')), set(lights[1:]))
+
+        index.remove(lights[0])
+        self.assertEqual(index.get_groups(), {hall: 'Hall'})
+
+    def test_rtt_estimator(self):
+        rtt = RttEstimator(initial_rto=1, min_rto=0.1, max_rto=3)
+        self.assertEqual(rtt.rto(), 1)
+        self.assertEqual(rtt.rto(1), 2)
+        self.assertEqual(rtt.rto(2), 3)
+
+        rtt.add_sample(0.02)
+        self.assertAlmostEqual(rtt.srtt, 0.02)
+        self.assertAlmostEqual(rtt.rttvar, 0.01)
+        self.assertEqual(rtt.rto(), 0.1)
+        self.assertEqual(rtt.rto(1), 0.2)
+
+        for _ in range(50):
+            rtt.add_sample(0.2)
+        self.assertAlmostEqual(rtt.srtt, 0.2, places=2)
+        self.assertGreater(rtt.rto(), 0.2)
+        self.assertLess(rtt.rto(), 0.3)
+
+    def test_rtt_per_light(self):
+        backend = LifxBackend(b'lcht', timeout=2, tries=4)
+        self.assertEqual((backend.timeout, backend.tries), (2, 4))
+        first = backend._get_rtt_estimator(('10.0.0.1', 56700, b'\x01' * 8))
+        self.assertIs(backend._get_rtt_estimator(('10.0.0.2', 56700, b'\x01' * 8)), first)
+        self.assertIsNot(backend._get_rtt_estimator(('10.0.0.1', 56700, b'\x02' * 8)), first)
+        self.assertEqual(first.max_rto, 2)
+
+
+class SimulatorTest(unittest.TestCase):
+    def test_discovery_and_index(self):
+        with LifxSimulator() as simulator, LifxBackend(b'lcht') as backend:
+            for i in range(20):
+                simulator.add_device(group='Kitchen' if i < 5 else 'Hall')
+            backend.broadcast_addr = simulator.addr
+            lights = list(backend.discover_lights(timeout=2, count=20))
+            self.assertEqual(len(lights), 20)
+
+            index = backend.build_index(lights)
+            self.assertEqual(sorted(index.get_groups().values()), ['Hall', 'Kitchen'])
+            self.assertEqual(len(index.get_group('Kitchen')), 5)
+            self.assertEqual(len(index.get_location('Simulated')), 20)
+
+    def test_light_state(self):
+        with LifxSimulator(1) as simulator, LifxBackend(b'lcht') as backend:
+            light, = simulator.get_lights(backend)
+            device, = simulator.devices.values()
+            light.set_color(LightColor(120, 1, 1))
+            light.set_power(LightPower.ON)
+            self.assertEqual(device.power, 65535)
+            self.assertEqual(
+                light.get_state(),
+                LightStatus(LightPower.ON, backend._to_color(device.color), 'Light 0'),
+            )
+            self.assertTrue(light.ping())
+
+    def test_zones(self):
+        with LifxSimulator() as simulator, LifxBackend(b'lcht') as backend:
+            device = simulator.add_device(zones=100)
+            light, = simulator.get_lights(backend)
+            hsbk = array('H', range(400))
+            # 100 zones need two packets and arrive in two states
+            self.assertEqual(light.set_zones(hsbk), hsbk)
+            self.assertEqual(device.received, 2)
+            self.assertEqual(device.zones, hsbk)
+
+            hsbk[-8:] = array('H', [1] * 8)
+            self.assertEqual(light.set_zones(hsbk[-8:], index=98, ack_mode=AckMode.ACK), hsbk[-8:])
+            self.assertEqual(light.get_zones(), hsbk)
+
+    def test_state_cache(self):
+        with LifxSimulator(1) as simulator, LifxBackend(b'lcht', state_ttl=60) as backend:
+            light, = simulator.get_lights(backend)
+            device, = simulator.devices.values()
+            self.assertEqual(light.get_state().power, LightPower.OFF)
+            self.assertEqual(light.get_power(), LightPower.OFF)
+            self.assertEqual(device.received, 1)
+
+            light.set_power(LightPower.ON)
+            self.assertEqual(light.get_power(), LightPower.ON)
+            self.assertEqual(device.received, 2)
+
+            # a label cut in the middle of a character only fails when the label is read
+            device.label = 'a' + '\xe4' * 16
+            backend.clear_state_cache()
+            self.assertEqual(light.get_color(), backend._to_color(device.color))
+            self.assertEqual(light.get_power(), LightPower.ON)
+            with self.assertRaises(UnicodeDecodeError):
+                backend.get_label(light)
+
+    def test_poller(self):
+        with LifxSimulator(3) as simulator, LifxBackend(b'lcht') as backend:
+            changes = queue.Queue()
+            poller = backend.poll_lights(
+                simulator.get_lights(backend), interval=0.05, jitter=0, callback=changes.put
+            )
+            with poller:
+                # power, color and label of every light
+                for _ in range(9):
+                    self.assertIsNone(changes.get(timeout=5).old)
+                device = next(iter(simulator.devices.values()))
+                device.power = 65535
+                change = changes.get(timeout=5)
+            light = simulator.get_lights(backend)[0]
+            self.assertEqual(change, LightChange(light, 'power', LightPower.OFF, LightPower.ON))
+
+    def test_poller_errors(self):
+        with LifxSimulator() as simulator, LifxBackend(b'lcht') as backend:
+            # the label is cut in the middle of a character
+            simulator.add_device('a' + '\xe4' * 16)
+            simulator.add_device()
+            broken, light = simulator.get_lights(backend)
+            changes = queue.Queue()
+            poller = backend.poll_lights(
+                [broken, light], interval=0.05, jitter=0, callback=changes.put
+            )
+            with poller, self.assertLogs('licht.lifx', 'ERROR'):
+                for _ in range(3):
+                    self.assertIs(changes.get(timeout=5).light, light)
+                simulator.devices[light.addr[2]].power = 65535
+                self.assertEqual(
+                    changes.get(timeout=5),
+                    LightChange(light, 'power', LightPower.OFF, LightPower.ON),
+                )
+            self.assertIsNone(poller.get_status(broken))
+
+    def test_bad_packets(self):
+        with LifxSimulator(1) as simulator, LifxBackend(b'lcht', timeout=0.2, tries=1) as backend:
+            light, = simulator.get_lights(backend)
+            # a SetPower without its payload
+            packet = backend._make_packet(light.addr[2], 0, MessageType.SetPower, res=True)
+            backend._get_shared_socket().sendto(packet, simulator.addr)
+            self.assertEqual(light.get_power(), LightPower.OFF)
+            self.assertEqual(simulator.dropped, 1)
+
+    def test_loss(self):
+        with LifxSimulator(5, loss=0.2, seed=1) as simulator, \
+                LifxBackend(b'lcht', timeout=10, tries=20) as backend:
+            backend.initial_rto = 0.05
+            results = backend.get_power_many(simulator.get_lights(backend))
+            self.assertTrue(all(result.error is None for result in results))
+            self.assertGreater(simulator.dropped, 0)
+
+    def test_rate_limit(self):
+        with LifxSimulator(1, rate=1e-6, burst=1) as simulator, \
+                LifxBackend(b'lcht', timeout=0.2, tries=1) as backend:
+            light, = simulator.get_lights(backend)
+            self.assertEqual(light.get_power(), LightPower.OFF)
+            with self.assertRaises(LichtTimeoutError):
+                light.get_power()
+            self.assertEqual(simulator.dropped, 1)
+
+    def test_metrics(self):
+        events = []
+        with LifxSimulator(2, rate=1e-6, burst=1) as simulator, \
+                LifxBackend(b'lcht', timeout=0.2, tries=2, observer=events.append) as backend:
+            metrics = backend.enable_metrics(spans=True)
+            lights = simulator.get_lights(backend)
+            lights[0].get_power()
+            with self.assertRaises(LichtTimeoutError):
+                lights[0].get_power()
+            lights[1].set_color(LightWhite(1, 3500), AckMode.NONE)
+
+        self.assertEqual([event.outcome for event in events], [
+            RequestOutcome.OK, RequestOutcome.TIMEOUT, RequestOutcome.SENT,
+        ])
+        ok, timeout, sent = events
+        self.assertEqual((ok.msg_type, ok.target), (MessageType.GetPower, lights[0].addr[2]))
+        self.assertEqual(ok.attempts, 1)
+        self.assertEqual(ok.bytes_sent, Header.total_bytes)
+        self.assertEqual(ok.bytes_received, Header.total_bytes + 2)
+        self.assertIsNotNone(ok.rtt)
+        self.assertIsNotNone(ok.decode_time)
+        self.assertEqual(timeout.attempts, 2)
+        self.assertIsNone(timeout.rtt)
+        self.assertEqual(sent.bytes_received, 0)
+
+        stats = metrics.by_type[MessageType.GetPower]
+        self.assertEqual((stats.requests, stats.attempts, stats.retries), (2, 3, 1))
+        self.assertEqual(stats.outcomes[RequestOutcome.TIMEOUT], 1)
+        self.assertEqual(metrics.by_light[lights[1].addr[2]].requests, 1)
+        self.assertEqual(metrics.as_dict()['total']['requests'], 3)
+
+    def test_observer_error(self):
+        def observer(event):
+            raise RuntimeError('observer failed')
+
+        with LifxSimulator(1) as simulator, LifxBackend(b'lcht', observer=observer) as backend:
+            light, = simulator.get_lights(backend)
+            with self.assertLogs('licht.lifx', 'ERROR'):
+                self.assertEqual(light.get_power(), LightPower.OFF)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for value in (0.00005, 0.0003, 0.0003, 0.002, 100):
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 0.0004)
+        self.assertEqual(histogram.percentile(80), 0.0032)
+        self.assertIsNone(histogram.percentile(100))
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+
+class AsyncBackendTest(unittest.TestCase):
+    def test_light_state(self):
+        async def run():
+            async with AsyncLifxBackend(b'lcht') as backend:
+                light, = simulator.get_lights(backend)
+                await light.set_power(LightPower.ON)
+                await light.set_color(LightColor(120, 1, 1))
+                self.assertEqual(await light.get_power(), LightPower.ON)
+                self.assertEqual(
+                    await light.get_state(),
+                    LightStatus(LightPower.ON, backend._to_color(device.color), 'Light 0'),
+                )
+                self.assertTrue(await light.ping())
+                with self.assertRaises(NotImplementedError):
+                    light.poll()
+
+        with LifxSimulator(1) as simulator:
+            device, = simulator.devices.values()
+            asyncio.run(run())
+            self.assertEqual(device.power, 65535)
+
+    def test_discovery(self):
+        async def run():
+            async with AsyncLifxBackend(b'lcht') as backend:
+                backend.broadcast_addr = simulator.addr
+                return [light async for light in backend.discover_lights(timeout=2, count=10)]
+
+        with LifxSimulator(10) as simulator:
+            lights = asyncio.run(run())
+            self.assertEqual(sorted(light.addr[2] for light in lights), sorted(simulator.devices))
+
+    def test_retries(self):
+        async def run():
+            async with AsyncLifxBackend(b'lcht', timeout=10, tries=20) as backend:
+                backend.initial_rto = 0.05
+                lights = simulator.get_lights(backend)
+                return await asyncio.gather(*(light.get_power() for light in lights * 5))
+
+        with LifxSimulator(4, loss=0.2, seed=1) as simulator:
+            self.assertEqual(asyncio.run(run()), [LightPower.OFF] * 20)
+            self.assertGreater(simulator.dropped, 0)
+
+    def test_timeout(self):
+        async def run():
+            async with AsyncLifxBackend(b'lcht', timeout=2, tries=3) as backend:
+                light, = simulator.get_lights(backend)
+                with self.assertRaises(LichtTimeoutError):
+                    await light.get_power()
+
+        with LifxSimulator(1, loss=1) as simulator:
+            asyncio.run(run())
+            self.assertEqual(simulator.received, 3)
+
+    def test_cache_coroutine(self):
+        async def run():
+            async with AsyncLifxBackend(b'lcht') as backend:
+                light, = simulator.get_lights(backend)
+                labels = await asyncio.gather(*(light.get_label() for _ in range(5)))
+                return labels + [await light.get_label()]
+
+        with LifxSimulator(1) as simulator:
+            device, = simulator.devices.values()
+            self.assertEqual(asyncio.run(run()), ['Light 0'] * 6)
+            self.assertEqual(device.received, 1)
+
+
+class CacheTest(unittest.TestCase):
+    class Thing(object):
+        calls = 0
+
+        @cache_method(maxsize=2)
+        def get(self):
+            self.calls += 1
+            return self.calls
+
+        @cache_method(ttl=0)
+        def get_uncached(self):
+            self.calls += 1
+            return self.calls
+
+    def test_cache(self):
+        thing = self.Thing()
+        self.assertEqual(thing.get(), 1)
+        self.assertEqual(thing.get(), 1)
+        self.assertEqual(thing.get_uncached(), 2)
+        self.assertEqual(thing.get_uncached(), 3)
+
+    def test_invalidate(self):
+        things = [self.Thing(), self.Thing()]
+        for thing in things:
+            thing.get()
+        invalidate_cached_methods(things[0], ['get'])
+        self.assertEqual([thing.get() for thing in things], [2, 1])
+
+        invalidate_cached_methods(things[0])
+        self.Thing.get.cache.invalidate(things[1])
+        self.assertEqual([thing.get() for thing in things], [3, 2])
+
+        self.Thing.get.cache.invalidate()
+        self.assertEqual(len(self.Thing.get.cache), 0)
+
+    def test_maxsize(self):
+        things = [self.Thing() for _ in range(3)]
+        for thing in things:
+            thing.get()
+        self.assertEqual(len(self.Thing.get.cache), 2)
+        self.assertEqual(things[0].get(), 2)
+        self.assertEqual(things[2].get(), 1)
+
+    def test_weak_references(self):
+        class VersionLight(Light):
+            __slots__ = ()
+
+            @cache_method
+            def get_version(self):
+                return 'version'
+
+        light = VersionLight(None, ('10.0.0.1', 56700, b'\x01' * 8))
+        self.assertEqual(light.get_version(), 'version')
+        self.assertEqual(len(VersionLight.get_version.cache), 1)
+        del light
+        gc.collect()
+        self.assertEqual(len(VersionLight.get_version.cache), 0)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        class Thing(object):
+            @cache_method
+            def get(self):
+                calls.append(None)
+                started.set()
+                release.wait()
+                return 'value'
+
+        thing = Thing()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(thing.get())) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class SchedulerTest(unittest.TestCase):
+    class Socket(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, packet, addr):
+            self.sent.append(packet)
+
+    def setUp(self):
+        self.sock = self.Socket()
+        self.scheduler = _SendScheduler(self.sock, rate=20, burst=2)
+
+    def make_request(self, packet, device=b'\x01' * 8, coalesce_key=None):
+        request = _PendingRequest(device, ('127.0.0.1', 56700), None, coalesce_key, 3, None, 0)
+        request.packet = packet
+        return request
+
+    def test_rate_limit(self):
+        for packet in (b'a', b'b', b'c'):
+            self.scheduler.send(self.make_request(packet))
+        self.scheduler.send(self.make_request(b'x', device=b'\x02' * 8))
+        self.assertEqual(self.sock.sent, [b'a', b'b', b'x'])
+
+        now = time.monotonic()
+        self.assertAlmostEqual(self.scheduler._send_ready(now), 0.05, places=2)
+        self.assertEqual(self.scheduler._send_ready(now + 0.05), None)
+        self.assertEqual(self.sock.sent, [b'a', b'b', b'x', b'c'])
+
+    def test_priority(self):
+        for packet in (b'a', b'b'):
+            self.scheduler.send(self.make_request(packet))
+        self.scheduler.send(self.make_request(b'background'), Priority.BACKGROUND)
+        self.scheduler.send(self.make_request(b'interactive'))
+        self.scheduler._send_ready(time.monotonic() + 0.05)
+        self.assertEqual(self.sock.sent[2:], [b'interactive'])
+
+    def test_coalesce(self):
+        requests = [
+            self.make_request(packet, coalesce_key=MessageType.SetPower)
+            for packet in (b'a', b'b', b'c', b'd', b'e')
+        ]
+        received = []
+        for request in requests:
+            request.listeners.append(received.append)
+            self.scheduler.send(request)
+        self.assertIs(requests[2].superseded_by, requests[3])
+        self.assertIs(requests[3].superseded_by, requests[4])
+
+        self.scheduler._send_ready(time.monotonic() + 1)
+        self.assertEqual(self.sock.sent, [b'a', b'b', b'e'])
+        requests[4].deliver('response')
+        self.assertEqual(received, ['response'] * 3)
+
+        # superseded requests are not sent again
+        self.scheduler.send(requests[2])
+        self.scheduler._send_ready(time.monotonic() + 2)
+        self.assertEqual(len(self.sock.sent), 3)
+
+    def test_coalesce_priority(self):
+        for packet in (b'a', b'b'):
+            self.scheduler.send(self.make_request(packet))
+        self.scheduler.send(self.make_request(b'other'), Priority.BACKGROUND)
+        background = self.make_request(b'background', coalesce_key=MessageType.SetPower)
+        self.scheduler.send(background, Priority.BACKGROUND)
+        interactive = self.make_request(b'interactive', coalesce_key=MessageType.SetPower)
+        self.scheduler.send(interactive)
+        self.assertIs(background.superseded_by, interactive)
+
+        self.scheduler._send_ready(time.monotonic() + 0.05)
+        self.assertEqual(self.sock.sent[2:], [b'interactive'])
+        self.scheduler._send_ready(time.monotonic() + 0.1)
+        self.assertEqual(self.sock.sent[2:], [b'interactive', b'other'])
+
+
+class BulkTest(unittest.TestCase):
+    class DummyBackend(Backend):
+        def get_power(self, light):
+            if light.addr is None:
+                raise LichtTimeoutError()
+            return LightPower.ON
+
+    def test_many(self):
+        backend = self.DummyBackend()
+        lights = [Light(backend, 1), Light(backend, None), Light(backend, 2)]
+
+        results = backend.get_power_many(lights)
+        self.assertEqual([r.light for r in results], lights)
+        self.assertEqual([r.value for r in results], [LightPower.ON, None, LightPower.ON])
+        self.assertIsInstance(results[1].error, LichtTimeoutError)
+
+        results = LightGroup(backend, lights).get_power(as_completed=True)
+        self.assertEqual({r.light for r in results}, set(lights))
+
+    def test_as_completed_sends_right_away(self):
+        # the requests are sent even if nobody iterates over the results
+        with LifxSimulator(2) as simulator, LifxBackend(b'lcht') as backend:
+            lights = simulator.get_lights(backend)
+            LightGroup(backend, lights).poweron(as_completed=True)
+            self.assertEqual(
+                [light.get_power() for light in lights], [LightPower.ON, LightPower.ON]
+            )
+
+        async def run():
+            async with AsyncLifxBackend(b'lcht') as backend:
+                lights = simulator.get_lights(backend)
+                backend.set_power_many(lights, LightPower.OFF, as_completed=True)
+                # the calls already run as tasks
+                await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+                return [await light.get_power() for light in lights]
+
+        with LifxSimulator(2) as simulator:
+            for device in simulator.devices.values():
+                device.power = 65535
+            self.assertEqual(asyncio.run(run()), [LightPower.OFF, LightPower.OFF])
+
+
+class EffectsTest(unittest.TestCase):
+    class Backend(Backend):
+        def __init__(self):
+            self.sent = []
+
+        def fade_color_many(self, lights, color, ms, as_completed=False, ack_mode=None):
+            self.sent.append((len(lights), color, ms, ack_mode))
+
+    def test_keyframes(self):
+        backend = self.Backend()
+        red, blue = LightColor(0, 1, 1), LightColor(240, 1, 1)
+        effect = Effect(None, [1, 2], [(red, 100), (red, 200), (blue, 300)], repeat=2)
+        effect.engine = EffectsEngine(backend)
+
+        due = 0
+        dues = []
+        while due is not None:
+            dues.append(due)
+            due = effect._advance(due)
+        self.assertEqual(dues, [0, 0.1, 0.3, 0.6, 0.7, 0.9, 1.2])
+        self.assertEqual(
+            backend.sent, [(2, red, 100, AckMode.NONE), (2, blue, 300, AckMode.NONE)] * 2
+        )
+        self.assertTrue(effect.done)
+
+    def test_engine(self):
+        backend = self.Backend()
+        with EffectsEngine(backend) as engine:
+            lights = LightGroup(backend, [Light(backend, 1), Light(backend, 2)])
+            first = engine.play(lights, [(LightWhite(1, 2700), 10), (LightWhite(0, 2700), 10)])
+            second = engine.play(Light(backend, 3), [(LightWhite(1, 2700), 1000)], repeat=None)
+            self.assertTrue(first.wait(1))
+            self.assertEqual([sent[0] for sent in backend.sent].count(2), 2)
+            self.assertFalse(second.done)
+        self.assertTrue(second.done)
+
+    def test_engine_errors(self):
+        with LifxSimulator(1) as simulator, LifxBackend(b'lcht') as backend, \
+                EffectsEngine(backend) as engine:
+            light, = simulator.get_lights(backend)
+            with self.assertLogs('licht.effects', 'ERROR'):
+                # the brightness doesn't fit into the packet
+                broken = engine.play(light, [(LightColor(0, 1, 1.5), 100)])
+                self.assertTrue(broken.wait(5))
+            effect = engine.play(light, [(LightColor(0, 1, 1), 10)])
+            self.assertTrue(effect.wait(5))
+
 
 class ColorsTest(unittest.TestCase):
     test_colors = [
@@ -109,6 +1079,46 @@ class ColorsTest(unittest.TestCase):
         for rgb, hsb in self.test_colors:
             self.assertEqual(LightColor(*hsb).rgb, rgb)
 
+    def numpy_modes(self):
+        # runs the body of the loop with the fallback and with NumPy if it is installed
+        for module in (None, colors.numpy) if colors.numpy is not None else (None,):
+            with self.subTest(numpy=module is not None), \
+                    mock.patch.object(colors, 'numpy', module):
+                yield
+
+    def test_batch(self):
+        rgbs = [rgb for rgb, hsb in self.test_colors] + [(10, 20, 30), (0, 0, 0)]
+        expected = []
+        for rgb in rgbs:
+            expected.extend(LifxBackend._color_to_hsbk(LightColor.from_rgb(rgb)))
+
+        for _ in self.numpy_modes():
+            hsbk = colors.rgb_to_hsbk(rgbs)
+            self.assertEqual(hsbk.tolist(), expected)
+            self.assertEqual(colors.rgb_to_hsbk(array('B', sum(rgbs, ()))).tolist(), expected)
+            self.assertEqual([tuple(rgb) for rgb in colors.hsbk_to_rgb(hsbk)], rgbs)
+            hsbs = [hsb for rgb, hsb in self.test_colors]
+            self.assertEqual(
+                colors.hsb_to_hsbk(hsbs, kelvin=2500).tolist(),
+                colors.rgb_to_hsbk(rgbs[:len(hsbs)], kelvin=2500).tolist(),
+            )
+            with self.assertRaises(ValueError):
+                colors.rgb_to_hsbk([1, 2, 3, 4])
+
+    def test_batch_colors(self):
+        values = [LightColor(120, 1, 0.5), LightWhite(0.5, 2700)]
+        for _ in self.numpy_modes():
+            hsbk = colors.colors_to_hsbk(values).tolist()
+            self.assertEqual(hsbk, [*LifxBackend._color_to_hsbk(values[0]), 0, 0, 32767, 2700])
+            self.assertEqual(
+                colors.hsbk_to_colors(hsbk),
+                [LifxBackend._to_color(HSBK(*hsbk[:4])), LightWhite(32767 / 65535, 2700)],
+            )
+            self.assertEqual(
+                colors.hsbk_to_bytes(hsbk),
+                HSBK(*hsbk[:4]).to_bytes() + HSBK(*hsbk[4:]).to_bytes(),
+            )
+
 
 if __name__ == '__main__':
     unittest.main()